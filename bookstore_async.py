@@ -0,0 +1,146 @@
+# asyncio facade over BookstoreDB for event-loop based services
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bookstore_clerk import BookstoreDB
+
+
+class AsyncBookstoreDB:
+    """Awaitable BookstoreDB operations run on a dedicated thread pool.
+
+    At most max_pending calls are queued or running at once; further callers
+    wait for a slot, which pushes back on whoever is producing the requests.
+    """
+
+    def __init__(self, bookstore, workers=4, max_pending=64):
+        self.bookstore = bookstore
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bookstore')
+        self._slots = None
+        self._pending = 0
+
+    # Open a BookstoreDB on a file and wrap it
+    @classmethod
+    async def open(cls, db_name='ebookstore.db', workers=4, max_pending=64):
+        bookstore = BookstoreDB(db_name, pool_size=workers)
+        facade = cls(bookstore, workers, max_pending)
+        # Opening the file and creating the schema both block, so they run
+        # on the pool like every other call
+        try:
+            if not await facade._run(bookstore.connect, read=False):
+                raise ConnectionError(f"Could not open {db_name}")
+            if not await facade._run(bookstore.initialize_database, read=False):
+                raise ConnectionError(f"Could not initialize {db_name}")
+        except BaseException:
+            # Do not leave the worker threads or the connection pool behind
+            await facade.close()
+            raise
+        return facade
+
+    @property
+    def pending(self):
+        """Number of calls queued or running"""
+        return self._pending
+
+    async def _run(self, func, *args, read=True, **kwargs):
+        # The semaphore belongs to the running loop, so create it lazily
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+
+        state = {'lock': threading.Lock(), 'conn': None, 'cancelled': False}
+        call = functools.partial(self._call, state, func, args, kwargs, read)
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        self._pending += 1
+        work = self._executor.submit(call)
+        # The slot is given back when the work itself is over, not when the
+        # caller stops waiting: a cancelled call may still be running
+        work.add_done_callback(lambda _: self._release_soon(loop))
+        try:
+            return await asyncio.wrap_future(work)
+        except asyncio.CancelledError:
+            # A read that is already running is stopped with interrupt();
+            # writes are short and always allowed to finish
+            with state['lock']:
+                state['cancelled'] = True
+                if state['conn'] is not None:
+                    state['conn'].interrupt()
+            raise
+
+    def _release_soon(self, loop):
+        # Called on a worker thread; the semaphore may only be touched from
+        # the loop's own thread
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._release)
+
+    def _release(self):
+        self._pending -= 1
+        self._slots.release()
+
+    def _call(self, state, func, args, kwargs, read):
+        if state['cancelled']:
+            return None
+        if not read:
+            return func(*args, **kwargs)
+
+        # Hold the connection ourselves so a cancelled read can be interrupted
+        with self.bookstore.pool.connection() as conn:
+            with state['lock']:
+                if state['cancelled']:
+                    return None
+                state['conn'] = conn
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with state['lock']:
+                    state['conn'] = None
+
+    # Writes
+    async def insert_book(self, book_id, title, author, qty):
+        return await self._run(self.bookstore.insert_book, book_id, title, author, qty, read=False)
+
+    async def add_books(self, books, chunk_size=5000):
+        return await self._run(self.bookstore.add_books, list(books), chunk_size,
+                               verbose=False, read=False)
+
+    async def edit_book(self, book_id, title=None, author=None, qty=None):
+        return await self._run(self.bookstore.edit_book, book_id, title, author, qty, read=False)
+
+    async def remove_book(self, book_id):
+        return await self._run(self.bookstore.remove_book, book_id, read=False)
+
+    async def sell(self, book_id, n=1):
+        return await self._run(self.bookstore.sell, book_id, n, read=False)
+
+    async def restock(self, book_id, n):
+        return await self._run(self.bookstore.restock, book_id, n, read=False)
+
+    async def checkout(self, basket):
+        return await self._run(self.bookstore.checkout, basket, read=False)
+
+    # Reads
+    async def get_book(self, book_id):
+        return await self._run(self.bookstore.get_book, book_id)
+
+    async def find_books(self, search_term, columns=('title', 'author'), prefix=False, limit=None):
+        return await self._run(self.bookstore.find_books, search_term, columns, prefix, limit)
+
+    async def fuzzy_find_books(self, search_term, columns=('title', 'author'), limit=10):
+        return await self._run(self.bookstore.fuzzy_find_books, search_term, columns, limit)
+
+    async def search_by_qty(self, min_qty, max_qty):
+        return await self._run(self.bookstore.search_by_qty, min_qty, max_qty)
+
+    async def low_stock_books(self):
+        return await self._run(self.bookstore.low_stock_books)
+
+    async def list_books(self, after_id=None, limit=50):
+        return await self._run(self.bookstore.list_books, after_id, limit)
+
+    async def close(self):
+        """Wait for running calls, then close the thread pool and database"""
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        self.bookstore.disconnect()
@@ -0,0 +1,765 @@
+# Benchmarks and stress tests for the bookstore database
+# Run with: python bookstore_bench.py <command> --help
+import argparse
+import itertools
+import json
+import platform
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from bookstore_clerk import (BookstoreDB, BOOK_BY_ID_SQL, QTY_RANGE_SQL, LOW_STOCK_SQL,
+                             BOOK_PAGE_SQL)
+from bookstore_replica import ReplicaApplier, open_replica
+
+WORDS = ["river", "shadow", "garden", "winter", "silver", "empire", "secret",
+         "ocean", "stone", "night", "crown", "forest", "letter", "summer"]
+AUTHORS = ["Ada Moss", "Ben Okafor", "Chen Li", "Dina Park", "Eli Stone",
+           "Femi Ade", "Greta Voss", "Hana Sato", "Ivan Petrov", "Jo March"]
+
+
+# Work out the value below which pct percent of the samples fall
+def percentile(values, pct):
+    """Return the pct-th percentile of values (nearest rank)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+# Make up a catalog of plausible books
+def synthetic_books(rows, seed=42):
+    """Yield (id, title, author, qty) tuples for a made-up catalog"""
+    rng = random.Random(seed)
+    for book_id in range(1, rows + 1):
+        title = " ".join(rng.choice(WORDS).capitalize() for _ in range(3))
+        yield (book_id, f"{title} {book_id}", rng.choice(AUTHORS), rng.randint(0, 60))
+
+
+# Create a temporary database filled with a synthetic catalog
+def make_catalog(directory, rows, name='bench.db'):
+    """Return a connected BookstoreDB holding rows synthetic books"""
+    bookstore = BookstoreDB(os.path.join(directory, name))
+    bookstore.connect()
+    bookstore.initialize_database()
+    # Load in slices so even 10M-row catalogs stay within memory
+    books = synthetic_books(rows)
+    while True:
+        chunk = list(itertools.islice(books, 100000))
+        if not chunk:
+            break
+        bookstore.add_books(chunk, verbose=False)
+    return bookstore
+
+
+# Hammer one database with concurrent readers and writers
+def stress(readers=8, writers=2, rows=10000, seconds=5.0):
+    """Report throughput and lock waits for concurrent readers and writers"""
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, rows)
+        bookstore.pool.size = readers + writers
+        stop = time.perf_counter() + seconds
+        results = {'read': [], 'write': [], 'lock_wait': [], 'errors': []}
+        results_lock = threading.Lock()
+
+        def reader(seed):
+            rng = random.Random(seed)
+            latencies = []
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                if rng.random() < 0.5:
+                    bookstore.find_books(rng.choice(WORDS), limit=20)
+                else:
+                    with bookstore.pool.connection():
+                        bookstore.cursor.execute(BOOK_BY_ID_SQL, (rng.randint(1, rows),))
+                        bookstore.cursor.fetchone()
+                latencies.append(time.perf_counter() - start)
+            with results_lock:
+                results['read'].extend(latencies)
+
+        def writer(seed):
+            rng = random.Random(seed)
+            latencies, waits, errors = [], [], []
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                try:
+                    with bookstore.pool.connection() as conn:
+                        # Time how long it takes to get the write lock
+                        conn.execute("BEGIN IMMEDIATE")
+                        waits.append(time.perf_counter() - start)
+                        conn.execute("UPDATE book SET qty = ? WHERE id = ?",
+                                     (rng.randint(0, 60), rng.randint(1, rows)))
+                        conn.commit()
+                except sqlite3.OperationalError as e:
+                    errors.append(str(e))
+                    continue
+                latencies.append(time.perf_counter() - start)
+            with results_lock:
+                results['write'].extend(latencies)
+                results['lock_wait'].extend(waits)
+                results['errors'].extend(errors)
+
+        threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+        threads += [threading.Thread(target=writer, args=(1000 + n,)) for n in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        pool_waits = (bookstore.pool.wait_count, bookstore.pool.wait_seconds)
+        bookstore.disconnect()
+
+    print(f"\n{readers} reader(s), {writers} writer(s), {rows} books, {seconds:.1f}s")
+    for kind in ('read', 'write'):
+        latencies = results[kind]
+        print(f"{kind:<6} {len(latencies) / seconds:>10.0f} ops/s   "
+              f"p50 {percentile(latencies, 50) * 1000:.2f} ms   "
+              f"p99 {percentile(latencies, 99) * 1000:.2f} ms")
+    waits = results['lock_wait']
+    print(f"write lock wait: mean {sum(waits) / max(len(waits), 1) * 1000:.2f} ms   "
+          f"p99 {percentile(waits, 99) * 1000:.2f} ms   max {max(waits, default=0) * 1000:.2f} ms")
+    print(f"pool waits: {pool_waits[0]} ({pool_waits[1] * 1000:.1f} ms total)")
+    print(f"'database is locked' errors: {len(results['errors'])}")
+    return results
+
+
+# Compare one commit per write with transactions and group commit
+def commit_modes(ops=2000, synchronous='NORMAL', group_ops=100, group_delay_ms=50):
+    """Time ops single-book writes under each commit strategy"""
+    def write_all(bookstore, first_id):
+        for book_id in range(first_id, first_id + ops):
+            bookstore.add_books([(book_id, f"Book {book_id}", "Bench Author", 10)], verbose=False)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = BookstoreDB(os.path.join(directory, 'commit.db'), synchronous=synchronous)
+        bookstore.connect()
+        bookstore.initialize_database()
+
+        start = time.perf_counter()
+        write_all(bookstore, 100000)
+        results['commit per write'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with bookstore.transaction():
+            write_all(bookstore, 200000)
+        results['one transaction'] = time.perf_counter() - start
+
+        bookstore.enable_group_commit(group_ops, group_delay_ms)
+        start = time.perf_counter()
+        write_all(bookstore, 300000)
+        bookstore.group_commit.flush()
+        results[f'group commit ({group_ops} ops / {group_delay_ms} ms)'] = time.perf_counter() - start
+        commits = bookstore.group_commit.commits
+        bookstore.disconnect()
+
+    print(f"\n{ops} writes, synchronous={synchronous}")
+    for mode, elapsed in results.items():
+        print(f"{mode:<36} {ops / elapsed:>10.0f} writes/s   {elapsed:.2f}s")
+    print(f"group commit used {commits} commit(s)")
+    return results
+
+
+# Time one operation over and over
+def time_operation(operation, iterations):
+    """Return latency percentiles and throughput for operation(i)"""
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - start)
+    total = sum(latencies)
+    return {
+        'n': iterations,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'ops_per_s': iterations / total if total else 0.0,
+    }
+
+
+# The SQL each BookstoreDB menu method runs, without the prompts
+def catalog_operations(bookstore, rows, seed=7):
+    rng = random.Random(seed)
+    next_id = [rows + 100000]
+
+    def run(sql, params=()):
+        bookstore.cursor.execute(sql, params)
+        return bookstore.cursor.fetchall()
+
+    def add_book(i):
+        book_id = next_id[0] + i
+        run("SELECT id FROM book WHERE id = ?", (book_id,))
+        run("INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)",
+            (book_id, f"Bench Title {book_id}", "Bench Author", 10))
+        bookstore.connection.commit()
+
+    def update_book(i):
+        book_id = rng.randint(1, rows)
+        book = run(BOOK_BY_ID_SQL, (book_id,))[0]
+        run("UPDATE book SET title = ?, author = ?, qty = ? WHERE id = ?",
+            (book[1], book[2], rng.randint(0, 60), book_id))
+        bookstore.connection.commit()
+
+    def delete_book(i):
+        # Delete the books add_book created so the catalog size stays put
+        book_id = next_id[0] + i
+        run("SELECT title, author FROM book WHERE id = ?", (book_id,))
+        run("DELETE FROM book WHERE id = ?", (book_id,))
+        bookstore.connection.commit()
+
+    def display_page(i):
+        run(BOOK_PAGE_SQL, (rng.randint(0, rows), 50))
+
+    return {
+        'add_book': add_book,
+        'update_book': update_book,
+        'delete_book': delete_book,
+        'search_title': lambda i: bookstore.find_books(rng.choice(WORDS), ('title',)),
+        'search_author': lambda i: bookstore.find_books(rng.choice(AUTHORS), ('author',)),
+        'search_title_or_author': lambda i: bookstore.find_books(rng.choice(WORDS)),
+        'search_id': lambda i: run(BOOK_BY_ID_SQL, (rng.randint(1, rows),)),
+        # Point-of-sale traffic keeps asking for the same few hundred books
+        'search_id_cached': lambda i: bookstore.get_book(rng.randint(1, min(rows, 300))),
+        'search_qty_range': lambda i: run(QTY_RANGE_SQL, (rng.randint(0, 59), rng.randint(0, 59) // 10 + 60)),
+        'search_low_stock': lambda i: run(LOW_STOCK_SQL),
+        'display_page': display_page,
+    }
+
+
+# Time every operation on catalogs of each size
+def suite(sizes=(10000,), iterations=200, scan_iterations=5):
+    """Return {size: {operation: stats}} for synthetic catalogs"""
+    results = {}
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            print(f"\nBuilding a {rows}-book catalog...")
+            bookstore = make_catalog(directory, rows)
+            stats = {}
+            with bookstore.pool.connection():
+                operations = catalog_operations(bookstore, rows)
+                for name, operation in operations.items():
+                    # Searches that return big slices of the catalog get fewer runs
+                    runs = scan_iterations if name in ('search_title', 'search_author',
+                                                       'search_title_or_author',
+                                                       'search_qty_range',
+                                                       'search_low_stock') else iterations
+                    stats[name] = time_operation(operation, runs)
+
+                # display_all_books streams every page once
+                start = time.perf_counter()
+                walked = sum(len(page) for page in bookstore.iter_book_pages(1000))
+                elapsed = time.perf_counter() - start
+                stats['display_all_books'] = {
+                    'n': 1, 'p50_ms': elapsed * 1000, 'p95_ms': elapsed * 1000,
+                    'p99_ms': elapsed * 1000, 'ops_per_s': 1 / elapsed if elapsed else 0.0,
+                    'rows_per_s': walked / elapsed if elapsed else 0.0,
+                }
+            bookstore.disconnect()
+
+        results[str(rows)] = stats
+        print(f"{'operation':<24} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10}")
+        for name, stat in stats.items():
+            print(f"{name:<24} {stat['p50_ms']:>9.3f} {stat['p95_ms']:>9.3f} "
+                  f"{stat['p99_ms']:>9.3f} {stat['ops_per_s']:>10.1f}")
+    return results
+
+
+# Flag operations that got slower than the stored baseline
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """Return a list of regressions where p50 grew by more than tolerance"""
+    regressions = []
+    for rows, stats in results.items():
+        for name, stat in stats.items():
+            base = baseline.get('results', {}).get(rows, {}).get(name)
+            if base and base['p50_ms'] > 0 and stat['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+                regressions.append(f"{rows} rows, {name}: p50 {base['p50_ms']:.3f} ms -> "
+                                   f"{stat['p50_ms']:.3f} ms")
+    return regressions
+
+
+# Requests per second through AsyncBookstoreDB with many concurrent callers
+def async_throughput(concurrency=200, rows=10000, seconds=5.0, workers=4, max_pending=64):
+    """Report completed requests/s and how late the event loop ran"""
+    import asyncio
+    from bookstore_async import AsyncBookstoreDB
+
+    async def run(bookstore):
+        facade = AsyncBookstoreDB(bookstore, workers, max_pending)
+        stop = time.perf_counter() + seconds
+        latencies, lags = [], []
+
+        async def client(seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                choice = rng.random()
+                if choice < 0.7:
+                    await facade.get_book(rng.randint(1, rows))
+                elif choice < 0.9:
+                    await facade.find_books(rng.choice(WORDS), limit=20)
+                else:
+                    await facade.edit_book(rng.randint(1, rows), qty=rng.randint(0, 60))
+                latencies.append(time.perf_counter() - start)
+
+        # A ticker that should wake every 10 ms shows whether the loop is stalled
+        async def ticker():
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - start - 0.01)
+
+        await asyncio.gather(ticker(), *(client(n) for n in range(concurrency)))
+        await facade.close()
+        return latencies, lags
+
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, rows)
+        bookstore.pool.size = workers
+        latencies, lags = asyncio.run(run(bookstore))
+
+    print(f"\n{concurrency} concurrent clients, {workers} worker thread(s), "
+          f"queue depth {max_pending}, {seconds:.1f}s")
+    print(f"requests/s        {len(latencies) / seconds:>10.0f}")
+    print(f"request latency   p50 {percentile(latencies, 50) * 1000:.2f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:.2f} ms")
+    print(f"event loop lag    p50 {percentile(lags, 50) * 1000:.2f} ms   "
+          f"p99 {percentile(lags, 99) * 1000:.2f} ms   max {max(lags, default=0) * 1000:.2f} ms")
+    return latencies, lags
+
+
+# Load-test the HTTP service with keep-alive clients
+def http_load(clients=16, rows=10000, seconds=5.0, workers=16):
+    """Report requests/s and latency for the bookstore HTTP service"""
+    import http.client
+    from bookstore_server import BookstoreHTTPServer
+
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, rows)
+        bookstore.pool.size = workers
+        server = BookstoreHTTPServer(('127.0.0.1', 0), bookstore, workers)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+        stop = time.perf_counter() + seconds
+        latencies, statuses = [], {}
+        results_lock = threading.Lock()
+
+        def client(seed):
+            rng = random.Random(seed)
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            etag = None
+            mine, codes = [], {}
+            while time.perf_counter() < stop:
+                choice = rng.random()
+                headers = {}
+                if choice < 0.6:
+                    path = f"/books/{rng.randint(1, rows)}"
+                elif choice < 0.8:
+                    path = f"/search?q={rng.choice(WORDS)}&limit=20"
+                else:
+                    # Repeated catalog page reads should mostly get 304s
+                    path = "/books?limit=50"
+                    if etag:
+                        headers['If-None-Match'] = etag
+                start = time.perf_counter()
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                mine.append(time.perf_counter() - start)
+                codes[response.status] = codes.get(response.status, 0) + 1
+                if path == "/books?limit=50":
+                    etag = response.getheader('ETag')
+            conn.close()
+            with results_lock:
+                latencies.extend(mine)
+                for code, count in codes.items():
+                    statuses[code] = statuses.get(code, 0) + count
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+        server.server_close()
+        bookstore.disconnect()
+
+    print(f"\n{clients} keep-alive client(s), {workers} worker(s), {rows} books, {seconds:.1f}s")
+    print(f"requests/s   {len(latencies) / seconds:>10.0f}")
+    print(f"latency      p50 {percentile(latencies, 50) * 1000:.2f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:.2f} ms")
+    print(f"status codes {dict(sorted(statuses.items()))}")
+    return latencies
+
+
+# Many tills selling the same few books at once must never oversell
+def sell_race(threads=16, stock=20000, books=5, seconds=5.0):
+    """Report sales/s and check that no book went below zero"""
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, 0)
+        bookstore.pool.size = threads
+        for book_id in range(1, books + 1):
+            bookstore.insert_book(book_id, f"Bestseller {book_id}", "Bench Author", stock)
+
+        stop = time.perf_counter() + seconds
+        counts = {'sold': 0, 'refused': 0, 'errors': 0}
+        counts_lock = threading.Lock()
+
+        def till(seed):
+            rng = random.Random(seed)
+            sold = refused = errors = 0
+            while time.perf_counter() < stop:
+                try:
+                    if rng.random() < 0.8:
+                        if bookstore.sell(rng.randint(1, books), 1):
+                            sold += 1
+                        else:
+                            refused += 1
+                    else:
+                        basket = {rng.randint(1, books): 1 for _ in range(3)}
+                        if bookstore.checkout(basket)['ok']:
+                            sold += sum(basket.values())
+                        else:
+                            refused += 1
+                except sqlite3.OperationalError:
+                    errors += 1
+            with counts_lock:
+                counts['sold'] += sold
+                counts['refused'] += refused
+                counts['errors'] += errors
+
+        workers = [threading.Thread(target=till, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        remaining = [bookstore.get_book(book_id)[3] for book_id in range(1, books + 1)]
+        bookstore.disconnect()
+
+    oversold = any(qty < 0 for qty in remaining) or counts['sold'] != books * stock - sum(remaining)
+    print(f"\n{threads} till(s) selling {books} book(s) with {stock} copies each for {seconds:.1f}s")
+    print(f"copies sold/s {counts['sold'] / seconds:>10.0f}")
+    print(f"sold {counts['sold']}, refused {counts['refused']}, errors {counts['errors']}, "
+          f"left {sum(remaining)}")
+    print("OVERSOLD!" if oversold else "No oversells: sold + remaining matches the starting stock.")
+    return counts
+
+
+# Time opening an existing catalog, as every launch of the clerk does
+def startup(rows=1000000, runs=10):
+    """Report connect + initialize_database time on an up-to-date catalog"""
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, rows)
+        path = bookstore.db_name
+        bookstore.disconnect()
+
+        def launch(i):
+            store = BookstoreDB(path)
+            store.connect()
+            store.initialize_database()
+            store.disconnect()
+
+        def old_seed_check(i):
+            # What every launch paid before migrations decided seeding
+            conn = sqlite3.connect(path)
+            conn.execute("SELECT COUNT(*) FROM book").fetchone()
+            conn.close()
+
+        launches = time_operation(launch, runs)
+        counts = time_operation(old_seed_check, runs)
+
+    print(f"\nStartup on a {rows}-book catalog ({runs} runs)")
+    print(f"{'':24}{'p50 ms':>10}{'p95 ms':>10}")
+    print(f"{'connect + migrate':24}{launches['p50_ms']:>10.2f}{launches['p95_ms']:>10.2f}")
+    print(f"{'old COUNT(*) alone':24}{counts['p50_ms']:>10.2f}{counts['p95_ms']:>10.2f}")
+    return {'startup': launches, 'count': counts}
+
+
+# Misspell one word of text by swapping two neighbouring letters
+def typo(text, rng):
+    words = text.split()
+    candidates = [i for i, word in enumerate(words) if len(word) >= 4 and word.isalpha()]
+    if not candidates:
+        return text
+    i = rng.choice(candidates)
+    word = words[i]
+    j = rng.randrange(len(word) - 1)
+    words[i] = word[:j] + word[j + 1] + word[j] + word[j + 2:]
+    return " ".join(words)
+
+
+# Compare exact and fuzzy title search on misspelt queries
+def fuzzy_search(rows=100000, queries=200, k=10, seed=11):
+    """Report recall@k and latency of find_books vs fuzzy_find_books"""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, rows)
+        cases = []
+        for book_id in rng.sample(range(1, rows + 1), min(queries, rows)):
+            title = bookstore.get_book(book_id)[1]
+            cases.append((book_id, typo(title, rng)))
+
+        results = {}
+        for name, search in (('exact', bookstore.find_books), ('fuzzy', bookstore.fuzzy_find_books)):
+            hits = 0
+
+            def run(i):
+                nonlocal hits
+                book_id, term = cases[i]
+                found = search(term, ('title',), limit=k)
+                hits += any(book[0] == book_id for book in found)
+
+            results[name] = time_operation(run, len(cases))
+            results[name]['recall'] = hits / len(cases)
+        bookstore.disconnect()
+
+    print(f"\nMisspelt title searches on a {rows}-book catalog ({len(cases)} queries, top {k})")
+    print(f"{'':8}{'recall':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        print(f"{name:8}{result['recall']:>10.1%}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+    return results
+
+
+# Keep a replica current while tills write to the primary
+def replica_lag(writers=2, readers=2, rows=10000, seconds=5.0):
+    """Report replica lag and check the replica ends up identical"""
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, rows)
+        applier = ReplicaApplier(bookstore.db_name, os.path.join(directory, 'replica.db')).open()
+        applier.start()
+        report_store = open_replica(applier.replica_path)
+
+        stop = time.perf_counter() + seconds
+        counts = {'writes': 0, 'reports': 0}
+        counts_lock = threading.Lock()
+
+        def till(seed):
+            rng = random.Random(seed)
+            done = 0
+            while time.perf_counter() < stop:
+                book_id = rng.randint(1, rows)
+                if rng.random() < 0.7:
+                    bookstore.sell(book_id, 1)
+                else:
+                    bookstore.restock(book_id, rng.randint(1, 5))
+                done += 1
+            with counts_lock:
+                counts['writes'] += done
+
+        def report(seed):
+            done = 0
+            while time.perf_counter() < stop:
+                report_store.low_stock_books()
+                done += 1
+            with counts_lock:
+                counts['reports'] += done
+
+        threads = ([threading.Thread(target=till, args=(n,)) for n in range(writers)]
+                   + [threading.Thread(target=report, args=(n,)) for n in range(readers)])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        applier.stop()
+        applier.catch_up()
+        with bookstore.pool.connection() as conn:
+            primary_rows = conn.execute("SELECT * FROM book ORDER BY id").fetchall()
+        with report_store.pool.connection() as conn:
+            replica_rows = conn.execute("SELECT * FROM book ORDER BY id").fetchall()
+        lag = sorted(applier.lag_samples)
+        applier.close()
+        report_store.disconnect()
+        bookstore.disconnect()
+
+    print(f"\n{writers} till(s) writing and {readers} report reader(s) on the replica for {seconds:.1f}s")
+    print(f"writes/s on the primary   {counts['writes'] / seconds:>10.0f}")
+    print(f"report queries/s          {counts['reports'] / seconds:>10.0f}")
+    print(f"changes applied           {applier.applied:>10}")
+    if lag:
+        print(f"replica lag p50/p95/p99   {percentile(lag, 50) * 1000:.1f} / "
+              f"{percentile(lag, 95) * 1000:.1f} / {percentile(lag, 99) * 1000:.1f} ms")
+    print("Replica matches the primary." if primary_rows == replica_rows else "REPLICA DIVERGED!")
+    return counts
+
+
+# Read syscalls and bytes this process has read so far (Linux only)
+def read_counters():
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return int(values['syscr']), int(values['rchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# Full-catalog scans on read-only connections, with and without mmap
+def scan_mmap(rows=2000000, runs=5, cache_kib=2048):
+    """Time full scans on a file much larger than SQLite's page cache"""
+    # Both runs get the same small page cache, so only mmap differs
+    profiles = {
+        'read() calls': {'mmap_size': 0, 'cache_size': -cache_kib, 'temp_store': 'MEMORY'},
+        'mmap': {'mmap_size': 1 << 31, 'cache_size': -cache_kib, 'temp_store': 'MEMORY'},
+    }
+    scan_sql = "SELECT COUNT(*), SUM(qty), SUM(length(title)) FROM book"
+    with tempfile.TemporaryDirectory() as directory:
+        bookstore = make_catalog(directory, rows)
+        with bookstore.pool.connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(bookstore.db_name)
+
+        # A till keeps selling during the scans; it must never wait for them
+        stop = threading.Event()
+        write_latencies = []
+
+        def till():
+            rng = random.Random(3)
+            while not stop.is_set():
+                start = time.perf_counter()
+                bookstore.restock(rng.randint(1, rows), 1)
+                write_latencies.append(time.perf_counter() - start)
+                time.sleep(0.001)
+
+        writer = threading.Thread(target=till)
+        writer.start()
+        results = {}
+        for name, pragmas in profiles.items():
+            reader = BookstoreDB(bookstore.db_name, read_only=True, profile=pragmas)
+            reader.connect()
+            with reader.pool.connection() as conn:
+                conn.execute(scan_sql).fetchone()  # warm the OS page cache
+                before = read_counters()
+                result = time_operation(lambda i: conn.execute(scan_sql).fetchone(), runs)
+                after = read_counters()
+            if before and after:
+                result['read_syscalls'] = (after[0] - before[0]) / runs
+                result['read_mb'] = (after[1] - before[1]) / runs / 1e6
+            results[name] = result
+            reader.disconnect()
+        stop.set()
+        writer.join()
+        bookstore.disconnect()
+
+    print(f"\nFull scans of a {size / 1e6:.0f} MB catalog ({rows} books), "
+          f"{cache_kib} KiB page cache, {runs} runs")
+    print(f"{'':14}{'p50 ms':>10}{'p95 ms':>10}{'read calls':>12}{'read MB':>10}")
+    for name, result in results.items():
+        print(f"{name:14}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+              f"{result.get('read_syscalls', float('nan')):>12.0f}{result.get('read_mb', float('nan')):>10.1f}")
+    if write_latencies:
+        print(f"till writes during the scans: {len(write_latencies)}, "
+              f"max {max(write_latencies) * 1000:.1f} ms")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bookstore benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stress_parser = commands.add_parser('stress', help="concurrent readers and writers")
+    stress_parser.add_argument('--readers', type=int, default=8)
+    stress_parser.add_argument('--writers', type=int, default=2)
+    stress_parser.add_argument('--rows', type=int, default=10000)
+    stress_parser.add_argument('--seconds', type=float, default=5.0)
+
+    commit_parser = commands.add_parser('commit', help="commit per write vs transaction vs group commit")
+    commit_parser.add_argument('--ops', type=int, default=2000)
+    commit_parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'])
+    commit_parser.add_argument('--group-ops', type=int, default=100)
+    commit_parser.add_argument('--group-delay-ms', type=float, default=50)
+
+    suite_parser = commands.add_parser('suite', help="latency of every BookstoreDB operation")
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[10000],
+                              help="catalog sizes, e.g. 10000 1000000 10000000")
+    suite_parser.add_argument('--iterations', type=int, default=200)
+    suite_parser.add_argument('--json', help="write the results to this JSON file")
+    suite_parser.add_argument('--baseline', help="JSON file from an earlier run to compare with")
+    suite_parser.add_argument('--tolerance', type=float, default=0.2,
+                              help="allowed p50 slowdown before flagging (default 0.2 = 20%%)")
+
+    async_parser = commands.add_parser('async', help="event-loop throughput of AsyncBookstoreDB")
+    async_parser.add_argument('--concurrency', type=int, default=200)
+    async_parser.add_argument('--rows', type=int, default=10000)
+    async_parser.add_argument('--seconds', type=float, default=5.0)
+    async_parser.add_argument('--workers', type=int, default=4)
+    async_parser.add_argument('--max-pending', type=int, default=64)
+
+    http_parser = commands.add_parser('http', help="load-test the HTTP/JSON service")
+    http_parser.add_argument('--clients', type=int, default=16)
+    http_parser.add_argument('--rows', type=int, default=10000)
+    http_parser.add_argument('--seconds', type=float, default=5.0)
+    http_parser.add_argument('--workers', type=int, default=16)
+
+    sell_parser = commands.add_parser('sell', help="concurrent sell/checkout race on hot books")
+    sell_parser.add_argument('--threads', type=int, default=16)
+    sell_parser.add_argument('--stock', type=int, default=20000)
+    sell_parser.add_argument('--books', type=int, default=5)
+    sell_parser.add_argument('--seconds', type=float, default=5.0)
+
+    startup_parser = commands.add_parser('startup', help="time opening an existing catalog")
+    startup_parser.add_argument('--rows', type=int, default=1000000)
+    startup_parser.add_argument('--runs', type=int, default=10)
+
+    fuzzy_parser = commands.add_parser('fuzzy', help="recall and latency of typo-tolerant search")
+    fuzzy_parser.add_argument('--rows', type=int, default=100000)
+    fuzzy_parser.add_argument('--queries', type=int, default=200)
+    fuzzy_parser.add_argument('--k', type=int, default=10)
+
+    replica_parser = commands.add_parser('replica', help="replica lag while tills write")
+    replica_parser.add_argument('--writers', type=int, default=2)
+    replica_parser.add_argument('--readers', type=int, default=2)
+    replica_parser.add_argument('--rows', type=int, default=10000)
+    replica_parser.add_argument('--seconds', type=float, default=5.0)
+
+    scan_parser = commands.add_parser('scan', help="full scans with and without mmap")
+    scan_parser.add_argument('--rows', type=int, default=2000000)
+    scan_parser.add_argument('--runs', type=int, default=5)
+    scan_parser.add_argument('--cache-kib', type=int, default=2048, help="SQLite page cache size")
+
+    args = parser.parse_args(argv)
+    if args.command == 'stress':
+        stress(args.readers, args.writers, args.rows, args.seconds)
+    elif args.command == 'commit':
+        commit_modes(args.ops, args.synchronous, args.group_ops, args.group_delay_ms)
+    elif args.command == 'async':
+        async_throughput(args.concurrency, args.rows, args.seconds, args.workers, args.max_pending)
+    elif args.command == 'http':
+        http_load(args.clients, args.rows, args.seconds, args.workers)
+    elif args.command == 'sell':
+        sell_race(args.threads, args.stock, args.books, args.seconds)
+    elif args.command == 'startup':
+        startup(args.rows, args.runs)
+    elif args.command == 'fuzzy':
+        fuzzy_search(args.rows, args.queries, args.k)
+    elif args.command == 'replica':
+        replica_lag(args.writers, args.readers, args.rows, args.seconds)
+    elif args.command == 'scan':
+        scan_mmap(args.rows, args.runs, args.cache_kib)
+    elif args.command == 'suite':
+        report = {
+            'meta': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                     'machine': platform.machine(), 'time': time.strftime("%Y-%m-%dT%H:%M:%S")},
+            'results': suite(args.sizes, args.iterations),
+        }
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"\nResults written to {args.json}")
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_to_baseline(report['results'], json.load(f), args.tolerance)
+            for regression in regressions:
+                print(f"REGRESSION: {regression}")
+            if regressions:
+                raise SystemExit(1)
+            print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,413 @@
 # Import necessary libraries
 import sqlite3
 import os
+import sys
+import json
+import re
+import time
+import argparse
+import functools
+import queue
+import threading
+import urllib.parse
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout
+
+import sql_trace
+from bookstore_render import BookRenderer
+
+# Books below this many copies are low stock unless they have their own threshold
+DEFAULT_LOW_STOCK = 5
+
+# UPDATE ... FROM needs SQLite 3.33 and RETURNING 3.35; older builds sell a
+# basket one line at a time instead
+SET_BASED_CHECKOUT = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# PRAGMA settings applied to every new connection, by profile name
+TUNING_PROFILES = {
+    'default': {},
+    # Long analytical reads: map the file instead of read() calls, keep a
+    # large page cache (negative sizes are KiB) and sort in memory
+    'reporting': {'mmap_size': 1 << 30, 'cache_size': -262144, 'temp_store': 'MEMORY'},
+    # Short till transactions touch few pages
+    'oltp': {'cache_size': -16384, 'temp_store': 'MEMORY'},
+}
+
+# Canned queries used by the menu, checked against EXPLAIN QUERY PLAN.
+# Each entry is (sql, sample params); none may scan book or sort in a temp B-tree.
+BOOK_BY_ID_SQL = "SELECT * FROM book WHERE id = ?"
+QTY_RANGE_SQL = "SELECT * FROM book WHERE qty BETWEEN ? AND ? ORDER BY qty ASC"
+BOOK_PAGE_SQL = "SELECT * FROM book WHERE id > ? ORDER BY id LIMIT ?"
+# Low stock is served from the low_stock registry, so it costs O(low-stock items)
+LOW_STOCK_SQL = """
+SELECT book.* FROM low_stock JOIN book ON book.id = low_stock.book_id
+ORDER BY low_stock.qty ASC, low_stock.book_id ASC
+"""
+LOW_STOCK_COUNT_SQL = "SELECT COUNT(*) FROM low_stock"
+
+CANNED_QUERIES = {
+    'search by id': (BOOK_BY_ID_SQL, (3001,)),
+    'search by quantity range': (QTY_RANGE_SQL, (1, 10)),
+    'search for low stock': (LOW_STOCK_SQL, ()),
+    'display all books (one page)': (BOOK_PAGE_SQL, (3000, 50)),
+    'count low stock': (LOW_STOCK_COUNT_SQL, ()),
+}
+
+# Three-character slices of the lowercased text, with a space at both ends
+# so word starts and ends count too
+def trigrams(text):
+    text = f" {' '.join(text.lower().split())} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# Pool of SQLite connections shared by every thread using one database file
+class ConnectionPool:
+    def __init__(self, db_name, size=5, busy_timeout=5000, timeout=30.0, synchronous='NORMAL',
+                 read_only=False, immutable=False, pragmas=None):
+        self.db_name = db_name
+        self.size = size
+        self.synchronous = synchronous
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+        self.pragmas = pragmas or {}
+        self.busy_timeout = busy_timeout
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        # Time spent waiting for a free connection when all are in use
+        self.wait_count = 0
+        self.wait_seconds = 0.0
+
+    # Open and configure a new connection
+    def _open(self):
+        """Open a connection set up for concurrent readers and writers"""
+        if self.read_only:
+            # mode=ro never takes a write lock, so readers cannot hold up the
+            # tills. immutable also skips all locking and change checks, and
+            # is only safe on snapshot files that nothing will ever modify.
+            uri = f"file:{urllib.parse.quote(os.path.abspath(self.db_name))}?mode=ro"
+            if self.immutable:
+                uri += "&immutable=1"
+            conn = sql_trace.connect(uri, uri=True, timeout=self.busy_timeout / 1000,
+                                     check_same_thread=False)
+            conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        else:
+            conn = sql_trace.connect(self.db_name, timeout=self.busy_timeout / 1000,
+                                     check_same_thread=False)
+            # WAL lets readers carry on while a writer commits
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+            # NORMAL is safe with WAL; FULL also survives power loss, OFF is fastest
+            conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    # Take a connection out of the pool, opening one if there is room
+    def acquire(self):
+        """Return an idle connection, waiting if the pool is exhausted"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            room = len(self._all) < self.size
+            if room:
+                self._all.append(None)
+        if room:
+            try:
+                conn = self._open()
+            except sqlite3.Error:
+                with self._lock:
+                    self._all.remove(None)
+                raise
+            with self._lock:
+                self._all[self._all.index(None)] = conn
+            return conn
+
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("timed out waiting for a pooled connection")
+        with self._lock:
+            self.wait_count += 1
+            self.wait_seconds += time.perf_counter() - start
+        return conn
+
+    # Hand a connection back to the pool
+    def release(self, conn):
+        """Return a connection, discarding any work left uncommitted"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for this thread; nested borrows share it"""
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            yield held[0]
+            return
+
+        conn = self.acquire()
+        try:
+            with self.use(conn):
+                yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def use(self, conn):
+        """Make conn the connection this thread is holding"""
+        # Each borrowing thread gets its own cursor
+        self._local.held = (conn, conn.cursor())
+        try:
+            yield conn
+        finally:
+            self._local.held = None
+
+    def current(self):
+        """Return the (connection, cursor) this thread holds, or None"""
+        return getattr(self._local, 'held', None)
+
+    # Close every connection that the pool has opened
+    def close(self):
+        """Close all connections"""
+        with self._lock:
+            connections, self._all = [c for c in self._all if c is not None], []
+        for conn in connections:
+            conn.close()
+
+
+# Shares one write transaction between many operations (group commit)
+class GroupCommitter:
+    def __init__(self, pool, max_ops=100, max_delay_ms=50, on_flush=None):
+        self.pool = pool
+        self.on_flush = on_flush
+        self.dirty = set()
+        self.max_ops = max_ops
+        self.max_delay = max_delay_ms / 1000
+        self.connection = pool.acquire()
+        # Writers take turns on the shared connection
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.first_pending = None
+        self.commits = 0
+
+        # Flush in the background so a quiet till is never left uncommitted
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._run, daemon=True)
+        self._flusher.start()
+
+    # Count a finished operation and commit once the group is full or old enough
+    def note_write(self, book_ids=()):
+        """Record one write on the shared connection"""
+        with self.lock:
+            self.pending += 1
+            self.dirty.update(book_ids)
+            if self.first_pending is None:
+                self.first_pending = time.perf_counter()
+            if (self.pending >= self.max_ops
+                    or time.perf_counter() - self.first_pending >= self.max_delay):
+                self.flush()
+
+    def flush(self):
+        """Commit every pending write now"""
+        with self.lock:
+            if self.connection.in_transaction:
+                self.connection.commit()
+                self.commits += 1
+            self.pending = 0
+            self.first_pending = None
+            dirty, self.dirty = self.dirty, set()
+            if self.on_flush and dirty:
+                self.on_flush(dirty)
+
+    def _run(self):
+        while not self._stop.wait(self.max_delay / 2):
+            with self.lock:
+                if (self.first_pending is not None
+                        and time.perf_counter() - self.first_pending >= self.max_delay):
+                    self.flush()
+
+    def close(self):
+        """Stop the background flusher, commit and hand the connection back"""
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        self.pool.release(self.connection)
+
+
+# Bounded LRU cache of book rows keyed by id
+class BookCache:
+    # Invalidation stamps kept before they are forgotten wholesale
+    STAMP_LIMIT = 10000
+
+    def __init__(self, capacity=1000, check_interval=0.05):
+        self.capacity = capacity
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        # Last PRAGMA data_version seen on each connection, and when. Commits
+        # made through this BookstoreDB invalidate their ids straight away, so
+        # the version only has to catch other processes, and is checked at
+        # most every check_interval seconds per connection.
+        self._versions = {}
+        self.check_interval = check_interval
+        # Every invalidation bumps _epoch and stamps the ids with it. A reader
+        # takes token() before its SELECT, and put() refuses the row if the id
+        # was invalidated after that, since the row read may be the old one.
+        self._epoch = 0
+        self._stamps = {}
+        # Readers that started before _floor cannot be checked and are refused
+        self._floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.external_clears = 0
+
+    # Notice commits made by other connections or processes
+    def check_version(self, conn):
+        """Empty the cache if someone else has written since conn last looked"""
+        now = time.monotonic()
+        seen = self._versions.get(id(conn))
+        if seen is not None and now - seen[1] < self.check_interval:
+            return
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        with self._lock:
+            last = self._versions.get(id(conn))
+            self._versions[id(conn)] = (version, now)
+            # A connection seen for the first time may have missed earlier writes
+            if last is None or last[0] != version:
+                self._epoch += 1
+                self._floor = self._epoch
+                self._stamps.clear()
+                if self._rows:
+                    self._rows.clear()
+                    self.external_clears += 1
+
+    def token(self):
+        """Take before reading a row from the database; pass to put()"""
+        return self._epoch
+
+    def get(self, book_id):
+        """Return the cached row or None"""
+        with self._lock:
+            row = self._rows.get(book_id)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(book_id)
+            self.hits += 1
+            return row
+
+    def put(self, book_id, row, token=None):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            # Invalidated while it was being read: the row may be stale
+            if token is not None and (token < self._floor
+                                      or self._stamps.get(book_id, 0) > token):
+                return
+            self._rows[book_id] = row
+            self._rows.move_to_end(book_id)
+            while len(self._rows) > self.capacity:
+                self._rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, book_ids):
+        """Forget the given ids"""
+        with self._lock:
+            self._epoch += 1
+            for book_id in book_ids:
+                self._stamps[book_id] = self._epoch
+                if self._rows.pop(book_id, None) is not None:
+                    self.invalidations += 1
+            if len(self._stamps) > self.STAMP_LIMIT:
+                self._stamps.clear()
+                self._floor = self._epoch
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._rows), 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'invalidations': self.invalidations,
+                'external_clears': self.external_clears,
+            }
+
+
+# Run a BookstoreDB method with a connection borrowed from the pool
+def borrows_connection(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.pool.connection():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# Run a BookstoreDB method that changes data; it commits through _commit()
+def writes(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._write_scope():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 # Define the BookstoreDB class
 class BookstoreDB:
-    def __init__(self, db_name='ebookstore.db'):
+    def __init__(self, db_name='ebookstore.db', pool_size=5, synchronous='NORMAL', cache_size=1000,
+                 read_only=False, immutable=False, profile='default'):
         self.db_name = db_name
-        self.connection = None
-        self.cursor = None
+        self.cache = BookCache(cache_size)
+        self.pool_size = pool_size
+        self.synchronous = synchronous
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+        # A profile name from TUNING_PROFILES, or a dict of PRAGMA settings
+        if isinstance(profile, str):
+            if profile not in TUNING_PROFILES:
+                raise ValueError(f"Unknown tuning profile {profile!r}")
+            profile = TUNING_PROFILES[profile]
+        self.pragmas = dict(profile)
+        self.pool = None
+        self.fts_enabled = False
+        self.fuzzy_enabled = False
+        self.group_commit = None
+        self._local = threading.local()
+
+    # The connection and cursor borrowed by the calling thread
+    @property
+    def connection(self):
+        held = self.pool.current() if self.pool else None
+        if held is None:
+            raise RuntimeError("No connection borrowed; call this from a BookstoreDB method")
+        return held[0]
+
+    @property
+    def cursor(self):
+        held = self.pool.current() if self.pool else None
+        if held is None:
+            raise RuntimeError("No connection borrowed; call this from a BookstoreDB method")
+        return held[1]
 
     # Connect to the database
     def connect(self):
         """ connection to the SQLite database"""
         try:
-            self.connection = sqlite3.connect(self.db_name)
-            self.cursor = self.connection.cursor()
+            self.pool = ConnectionPool(self.db_name, self.pool_size,
+                                       synchronous=self.synchronous, read_only=self.read_only,
+                                       immutable=self.immutable, pragmas=self.pragmas)
+            # Open the first connection now so errors show up straight away
+            with self.pool.connection():
+                pass
             return True
 
         # If the database file does not exist, it will be created
@@ -25,22 +418,191 @@ class BookstoreDB:
     # Disconnect from the database
     def disconnect(self):
         """Close the connection"""
-        if self.connection:
-            self.connection.close()
+        self.disable_group_commit()
+        if self.pool:
+            self.pool.close()
+
+    # Several changes that succeed or fail together
+    @contextmanager
+    def transaction(self):
+        """Share one commit between every change made inside the with block.
+
+        Any exception, or a failed write inside the block, rolls back the batch.
+        """
+        if getattr(self._local, 'transaction', None) is not None:
+            yield self
+            return
+
+        with self.pool.connection() as conn:
+            if conn.in_transaction:
+                conn.commit()
+            # Take the write lock up front so the batch cannot deadlock later
+            conn.execute("BEGIN IMMEDIATE")
+            transaction = self._local.transaction = {'failed': None, 'dirty': set()}
+            try:
+                yield self
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                if transaction['failed']:
+                    conn.rollback()
+                    raise sqlite3.DatabaseError(f"Transaction rolled back: {transaction['failed']}")
+                conn.commit()
+            finally:
+                self._local.transaction = None
+                self.cache.invalidate(transaction['dirty'])
+
+    # Trade durability for throughput by committing writes in groups
+    def enable_group_commit(self, max_ops=100, max_delay_ms=50):
+        """Commit writes made outside transaction() every max_ops or max_delay_ms"""
+        self.disable_group_commit()
+        self.group_commit = GroupCommitter(self.pool, max_ops, max_delay_ms,
+                                           on_flush=self.cache.invalidate)
+
+    def disable_group_commit(self):
+        """Flush pending writes and go back to one commit per change"""
+        if self.group_commit:
+            self.group_commit.close()
+            self.group_commit = None
+
+    @contextmanager
+    def _write_scope(self):
+        # Join whatever connection this thread already holds (e.g. a transaction)
+        if self.pool.current() is not None:
+            yield
+        elif self.group_commit:
+            group = self.group_commit
+            with group.lock, self.pool.use(group.connection) as conn:
+                try:
+                    yield
+                finally:
+                    # Nothing was written, so do not keep the write lock
+                    if not group.pending and conn.in_transaction:
+                        conn.commit()
+        else:
+            with self.pool.connection():
+                yield
+
+    # Open the shared group transaction before a multi-statement write
+    def _begin_write(self):
+        if (self.group_commit and self.connection is self.group_commit.connection
+                and not self.connection.in_transaction):
+            self.connection.execute("BEGIN IMMEDIATE")
 
-    # Initialize the database with the book table and default data
-    # Create the book table and populate it with initial data
+    # Commit a finished change, unless it belongs to a larger batch
+    def _commit(self, book_ids=()):
+        # Drop cached rows both now and once the change is really committed,
+        # so a reader cannot re-cache the old row in between
+        self.cache.invalidate(book_ids)
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is not None:
+            transaction['dirty'].update(book_ids)
+            return
+        if self.group_commit and self.connection is self.group_commit.connection:
+            self.group_commit.note_write(book_ids)
+        else:
+            self.connection.commit()
+            self.cache.invalidate(book_ids)
+
+    # A change failed, so an enclosing transaction must not commit
+    def _operation_failed(self, error):
+        if getattr(self._local, 'transaction', None) is not None:
+            self._local.transaction['failed'] = str(error)
+
+    # Ordered schema steps. A database whose PRAGMA user_version is N has
+    # already run the first N of them. Every step must be safe to run again,
+    # because a crash can happen after a step and before the version bump.
+    MIGRATIONS = (
+        ('book table and default books', '_migrate_book_table'),
+        ('full-text search index', 'create_search_index'),
+        ('low-stock registry', 'create_low_stock_registry'),
+        ('catalog version counter', 'create_catalog_version'),
+        ('quantity covering index', '_migrate_qty_index'),
+        ('trigram index for fuzzy search', 'create_trigram_index'),
+        ('book change log', 'create_change_log'),
+        ('threshold change log', 'create_threshold_change_log'),
+    )
+
+    # Bring the schema up to date, then make sure the indexes are used
+    @borrows_connection
     def initialize_database(self):
+        """Apply any pending migrations; returns False if that fails"""
+        try:
+            if self.read_only:
+                self.check_schema_current()
+            else:
+                self.migrate()
+            self.fts_enabled = self.has_table('book_fts')
+            self.fuzzy_enabled = self.has_table('book_trigram')
+            self.check_query_plans()
+            return True
+
+        # If an error occurs during initialization
+        except sqlite3.Error as e:
+            print(f"Failure to initialize database: {e}")
+            return False
+        except RuntimeError as e:
+            print(f"Query plan check failed: {e}")
+            return False
+
+    @borrows_connection
+    def schema_version(self):
+        """Return how many migrations this database has run"""
+        self.cursor.execute("PRAGMA user_version")
+        return self.cursor.fetchone()[0]
+
+    # A read-only connection cannot migrate, so the file must be up to date
+    def check_schema_current(self):
+        version = self.schema_version()
+        if version != len(self.MIGRATIONS):
+            raise sqlite3.DatabaseError(f"database schema version {version} does not match this "
+                                        f"program ({len(self.MIGRATIONS)}); open it read-write "
+                                        f"once to migrate it")
+
+    # Run the migrations this database has not seen yet, in order
+    @borrows_connection
+    def migrate(self, verbose=False):
+        """Apply pending migrations and return how many were applied"""
+        version = self.schema_version()
+        if version > len(self.MIGRATIONS):
+            raise sqlite3.DatabaseError(f"database schema version {version} is newer than this "
+                                        f"program ({len(self.MIGRATIONS)}); please upgrade")
+
+        pending = self.MIGRATIONS[version:]
+        for number, (description, method) in enumerate(pending, version + 1):
+            if verbose:
+                print(f"Applying migration {number}: {description}")
+            getattr(self, method)()
+            # user_version is stored in the file header and cannot be a parameter
+            self.cursor.execute(f"PRAGMA user_version = {number}")
+            self.connection.commit()
+        return len(pending)
+
+    @borrows_connection
+    def has_table(self, name):
+        self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        )
+        return self.cursor.fetchone() is not None
+
+    # Migration 1: the book table, seeded only when this step creates it
+    def _migrate_book_table(self):
         """Create the book table and populate it with initial data"""
-        create_table_sql = """
-        CREATE TABLE IF NOT EXISTS book (
+        # Databases from before migrations already have a book table and
+        # keep their books, even if the clerk has deleted every one of them
+        if self.has_table('book'):
+            return
+
+        self.cursor.execute("""
+        CREATE TABLE book (
             id INTEGER PRIMARY KEY,
             title TEXT NOT NULL,
             author TEXT NOT NULL,
             qty INTEGER NOT NULL
         )
-        """
-        
+        """)
+
         # Initial book data
         initial_books = [
             (3001, "A Tale of Two Cities", "Charles Dickens", 30),
@@ -49,32 +611,680 @@ class BookstoreDB:
             (3004, "The Lord of the Rings", "J.R.R Tolkien", 37),
             (3005, "Alice in Wonderland", "Lewis Carroll", 12)
         ]
-        
-        
+        self.cursor.executemany(
+            "INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)",
+            initial_books
+        )
+        # Print a message indicating successful initialization
+        print("Database created with default books.")
+
+    # Migration 5: covering index so quantity range and low stock searches
+    # never touch the table or sort: it holds every column of book
+    def _migrate_qty_index(self):
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS book_qty_idx ON book (qty, id, title, author)"
+        )
+
+    # Make sure the canned queries still use their indexes
+    @borrows_connection
+    def check_query_plans(self, verbose=False):
+        """Raise RuntimeError if a canned query scans the table or sorts in a temp B-tree"""
+        problems = []
+        for name, (sql, params) in CANNED_QUERIES.items():
+            self.cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            steps = [row[3] for row in self.cursor.fetchall()]
+            if verbose:
+                print(f"{name}: {'; '.join(steps)}")
+            for step in steps:
+                # Scanning small side tables such as low_stock is fine
+                if 'TEMP B-TREE' in step or re.match(r"SCAN book\b", step):
+                    problems.append(f"{name}: {step}")
+
+        if problems:
+            raise RuntimeError("; ".join(problems))
+        return True
+
+    # Create the low-stock registry that triggers keep up to date
+    def create_low_stock_registry(self):
+        """Create per-title thresholds, the low_stock table and their triggers"""
+        exists = self.has_table('low_stock')
+
+        # Which threshold applies to a book: its own, or the default
+        threshold = f"COALESCE((SELECT threshold FROM stock_threshold WHERE book_id = {{0}}), {DEFAULT_LOW_STOCK})"
+        refresh = f"""
+            DELETE FROM low_stock WHERE book_id = {{0}};
+            INSERT INTO low_stock (book_id, qty, threshold)
+            SELECT id, qty, {threshold} FROM book
+            WHERE id = {{0}} AND qty < {threshold};
+        """
+        self.cursor.executescript(f"""
+        CREATE TABLE IF NOT EXISTS stock_threshold (
+            book_id INTEGER PRIMARY KEY,
+            threshold INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS low_stock (
+            book_id INTEGER PRIMARY KEY,
+            qty INTEGER NOT NULL,
+            threshold INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS low_stock_qty_idx ON low_stock (qty, book_id);
+
+        CREATE TRIGGER IF NOT EXISTS low_stock_insert AFTER INSERT ON book BEGIN
+            {refresh.format('new.id')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS low_stock_update AFTER UPDATE OF id, qty ON book BEGIN
+            DELETE FROM low_stock WHERE book_id = old.id;
+            {refresh.format('new.id')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS low_stock_delete AFTER DELETE ON book BEGIN
+            DELETE FROM low_stock WHERE book_id = old.id;
+            DELETE FROM stock_threshold WHERE book_id = old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS low_stock_threshold_insert AFTER INSERT ON stock_threshold BEGIN
+            {refresh.format('new.book_id')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS low_stock_threshold_update AFTER UPDATE ON stock_threshold BEGIN
+            DELETE FROM low_stock WHERE book_id = old.book_id;
+            {refresh.format('new.book_id')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS low_stock_threshold_delete AFTER DELETE ON stock_threshold BEGIN
+            {refresh.format('old.book_id')}
+        END;
+        """)
+
+        # Fill the registry from books stored before it existed
+        if not exists:
+            self.rebuild_low_stock()
+
+    # The low-stock rows the registry should hold, worked out from scratch
+    EXPECTED_LOW_STOCK_SQL = f"""
+    SELECT book.id, book.qty, COALESCE(stock_threshold.threshold, {DEFAULT_LOW_STOCK})
+    FROM book LEFT JOIN stock_threshold ON stock_threshold.book_id = book.id
+    WHERE book.qty < COALESCE(stock_threshold.threshold, {DEFAULT_LOW_STOCK})
+    """
+
+    @borrows_connection
+    def rebuild_low_stock(self):
+        """Recompute the low_stock registry from the book table"""
+        self.cursor.execute("DELETE FROM low_stock")
+        self.cursor.execute(
+            f"INSERT INTO low_stock (book_id, qty, threshold) {self.EXPECTED_LOW_STOCK_SQL}"
+        )
+        self.connection.commit()
+
+    @borrows_connection
+    def verify_low_stock(self):
+        """Return the ids whose registry entry is missing, extra or out of date"""
+        self.cursor.execute(f"""
+        SELECT id FROM (
+            SELECT * FROM ({self.EXPECTED_LOW_STOCK_SQL})
+            EXCEPT SELECT book_id, qty, threshold FROM low_stock
+        )
+        UNION
+        SELECT book_id FROM (
+            SELECT book_id, qty, threshold FROM low_stock
+            EXCEPT SELECT * FROM ({self.EXPECTED_LOW_STOCK_SQL})
+        )
+        """)
+        return [row[0] for row in self.cursor.fetchall()]
+
+    # Ids and count of every low-stock book, straight from the registry
+    @borrows_connection
+    def low_stock_ids(self):
+        """Return the set of ids currently below their threshold"""
+        self.cursor.execute("SELECT book_id FROM low_stock")
+        return {row[0] for row in self.cursor.fetchall()}
+
+    @borrows_connection
+    def low_stock_count(self):
+        self.cursor.execute(LOW_STOCK_COUNT_SQL)
+        return self.cursor.fetchone()[0]
+
+    # Give one title its own low-stock threshold (None goes back to the default)
+    @writes
+    def set_low_stock_threshold(self, book_id, threshold):
+        """Set or clear the low-stock threshold for one book"""
+        if threshold is None:
+            self.cursor.execute("DELETE FROM stock_threshold WHERE book_id = ?", (book_id,))
+        else:
+            self.cursor.execute(
+                "INSERT INTO stock_threshold (book_id, threshold) VALUES (?, ?) "
+                "ON CONFLICT (book_id) DO UPDATE SET threshold = excluded.threshold",
+                (book_id, threshold)
+            )
+        self._commit()
+        return True
+
+    # Sell or restock copies of one book from the menu
+    def adjust_stock(self):
+        """Record a sale or a delivery for one book"""
+        print("\n--- Sell / Restock ---")
         try:
-            self.cursor.execute(create_table_sql)
-            
-            # Check if table is empty before inserting initial data
-            self.cursor.execute("SELECT COUNT(*) FROM book")
-            count = self.cursor.fetchone()[0]
+            book_id = int(input("Enter the ID of the book: "))
+            action = input("Sell or restock? (s/r): ").strip().lower()
+            if action not in ('s', 'r'):
+                print("Please enter 's' to sell or 'r' to restock.")
+                return False
+            n = int(input("How many copies? "))
+            if n <= 0:
+                print("Error: Please enter a positive number of copies.")
+                return False
 
-            # If the table is empty, add the  data
-            if count == 0:
-                self.cursor.executemany(
-                    "INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)",
-                    initial_books
-                )
-                # Print a message indicating successful initialization
-                print("Database created with default books.")
+            if action == 's':
+                if not self.sell(book_id, n):
+                    book = self.get_book(book_id)
+                    if not book:
+                        print("Error: No book found with that ID.")
+                    else:
+                        print(f"Error: Only {book[3]} cop(ies) of '{book[1]}' in stock.")
+                    return False
+                print("Sale recorded.")
+            else:
+                if not self.restock(book_id, n):
+                    print("Error: No book found with that ID.")
+                    return False
+                print("Stock updated.")
+            return True
 
-            self.connection.commit()
+        except ValueError:
+            print("Error: Please enter valid numeric values for ID and copies.")
+            return False
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return False
+
+    # Ask the clerk for a book and its new low-stock threshold
+    def set_threshold(self):
+        """Set a per-title low-stock threshold from the menu"""
+        print("\n--- Set Low-Stock Threshold ---")
+        try:
+            book_id = int(input("Enter the ID of the book: "))
+            book = self.get_book(book_id)
+            if not book:
+                print("Error: No book found with that ID.")
+                return False
+
+            value = input(f"Alert when '{book[1]}' has fewer than how many copies? "
+                          f"(press Enter for the default of {DEFAULT_LOW_STOCK}): ").strip()
+            threshold = int(value) if value else None
+            self.set_low_stock_threshold(book_id, threshold)
+            print("Threshold saved.")
             return True
 
-        # If an error occurs during initialization
+        except ValueError:
+            print("Error: Please enter valid numeric values for ID and threshold.")
+            return False
         except sqlite3.Error as e:
-            print(f"Failure to initialize database: {e}")
+            print(f"Database error: {e}")
             return False
 
+    # A counter that moves on every catalog change, used for HTTP ETags
+    def create_catalog_version(self):
+        """Create the catalog_version row and the triggers that bump it"""
+        bump = "UPDATE catalog_version SET version = version + 1 WHERE id = 1;"
+        triggers = "\n".join(
+            f"CREATE TRIGGER IF NOT EXISTS catalog_version_{table}_{event.lower()} "
+            f"AFTER {event} ON {table} BEGIN {bump} END;"
+            for table in ('book', 'stock_threshold')
+            for event in ('INSERT', 'UPDATE', 'DELETE')
+        )
+        self.cursor.executescript(f"""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0);
+        {triggers}
+        """)
+
+    @borrows_connection
+    def catalog_version(self):
+        """Return a number that changes whenever books or thresholds change"""
+        self.cursor.execute("SELECT version FROM catalog_version WHERE id = 1")
+        return self.cursor.fetchone()[0]
+
+    # Append-only log of every change to book, read by replicas
+    def create_change_log(self):
+        """Create the book_changes table and the triggers that fill it"""
+        # AUTOINCREMENT keeps sequence numbers increasing even after pruning
+        now = "(julianday('now') - 2440587.5) * 86400.0"
+        self.cursor.executescript(f"""
+        CREATE TABLE IF NOT EXISTS book_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL CHECK (op IN ('upsert', 'delete')),
+            book_id INTEGER NOT NULL,
+            title TEXT,
+            author TEXT,
+            qty INTEGER,
+            changed_at REAL NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS book_changes_insert AFTER INSERT ON book BEGIN
+            INSERT INTO book_changes (op, book_id, title, author, qty, changed_at)
+            VALUES ('upsert', new.id, new.title, new.author, new.qty, {now});
+        END;
+        CREATE TRIGGER IF NOT EXISTS book_changes_update AFTER UPDATE ON book BEGIN
+            INSERT INTO book_changes (op, book_id, changed_at)
+            SELECT 'delete', old.id, {now} WHERE old.id <> new.id;
+            INSERT INTO book_changes (op, book_id, title, author, qty, changed_at)
+            VALUES ('upsert', new.id, new.title, new.author, new.qty, {now});
+        END;
+        CREATE TRIGGER IF NOT EXISTS book_changes_delete AFTER DELETE ON book BEGIN
+            INSERT INTO book_changes (op, book_id, changed_at)
+            VALUES ('delete', old.id, {now});
+        END;
+        """)
+
+    # Per-title thresholds are logged separately, so replicas can answer
+    # low-stock queries too
+    def create_threshold_change_log(self):
+        """Create the threshold_changes table and the triggers that fill it"""
+        now = "(julianday('now') - 2440587.5) * 86400.0"
+        self.cursor.executescript(f"""
+        CREATE TABLE IF NOT EXISTS threshold_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            threshold INTEGER,
+            changed_at REAL NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS threshold_changes_insert AFTER INSERT ON stock_threshold BEGIN
+            INSERT INTO threshold_changes (book_id, threshold, changed_at)
+            VALUES (new.book_id, new.threshold, {now});
+        END;
+        CREATE TRIGGER IF NOT EXISTS threshold_changes_update AFTER UPDATE ON stock_threshold BEGIN
+            INSERT INTO threshold_changes (book_id, threshold, changed_at)
+            SELECT old.book_id, NULL, {now} WHERE old.book_id <> new.book_id;
+            INSERT INTO threshold_changes (book_id, threshold, changed_at)
+            VALUES (new.book_id, new.threshold, {now});
+        END;
+        CREATE TRIGGER IF NOT EXISTS threshold_changes_delete AFTER DELETE ON stock_threshold BEGIN
+            INSERT INTO threshold_changes (book_id, threshold, changed_at)
+            VALUES (old.book_id, NULL, {now});
+        END;
+        """)
+
+    # Drop change log entries every replica has already applied. A replica
+    # that is further behind notices the gap and takes a new snapshot.
+    @writes
+    def prune_change_log(self, upto_seq, upto_threshold_seq=None):
+        """Delete change log entries with seq <= upto_seq (and threshold log
+        entries with seq <= upto_threshold_seq); returns how many"""
+        self.cursor.execute("DELETE FROM book_changes WHERE seq <= ?", (upto_seq,))
+        pruned = self.cursor.rowcount
+        if upto_threshold_seq is not None:
+            self.cursor.execute("DELETE FROM threshold_changes WHERE seq <= ?",
+                                (upto_threshold_seq,))
+            pruned += self.cursor.rowcount
+        self._commit()
+        return pruned
+
+    # Look up one book by id, using the cache when possible
+    @borrows_connection
+    def get_book(self, book_id):
+        """Return the (id, title, author, qty) row for book_id, or None"""
+        self.cache.check_version(self.connection)
+        book = self.cache.get(book_id)
+        if book is None:
+            token = self.cache.token()
+            self.cursor.execute(BOOK_BY_ID_SQL, (book_id,))
+            book = self.cursor.fetchone()
+            if book is not None:
+                self.cache.put(book_id, book, token)
+        return book
+
+    # Look up many books at once, in id order
+    @borrows_connection
+    def get_books(self, book_ids):
+        """Return the (id, title, author, qty) rows of the ids that exist"""
+        self.cursor.execute(
+            "SELECT * FROM book WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id",
+            (json.dumps(list(book_ids)),)
+        )
+        return self.cursor.fetchall()
+
+    # Create the full-text index that mirrors book.title and book.author
+    def create_search_index(self):
+        """Create the FTS5 search table and its sync triggers if needed"""
+        exists = self.has_table('book_fts')
+
+        try:
+            self.cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+                title, author, content='book', content_rowid='id'
+            )
+            """)
+        # Older SQLite builds may not ship FTS5, so fall back to LIKE searches
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable, using slower searches: {e}")
+            return False
+
+        # Keep the index in sync with every insert, update and delete on book
+        self.cursor.executescript("""
+        CREATE TRIGGER IF NOT EXISTS book_fts_insert AFTER INSERT ON book BEGIN
+            INSERT INTO book_fts (rowid, title, author)
+            VALUES (new.id, new.title, new.author);
+        END;
+        CREATE TRIGGER IF NOT EXISTS book_fts_delete AFTER DELETE ON book BEGIN
+            INSERT INTO book_fts (book_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+        END;
+        CREATE TRIGGER IF NOT EXISTS book_fts_update AFTER UPDATE OF id, title, author ON book BEGIN
+            INSERT INTO book_fts (book_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+            INSERT INTO book_fts (rowid, title, author)
+            VALUES (new.id, new.title, new.author);
+        END;
+        """)
+
+        # Index any books that were stored before the search table existed
+        if not exists:
+            self.cursor.execute("INSERT INTO book_fts (book_fts) VALUES ('rebuild')")
+        return True
+
+    # Find books by title and/or author, best matches first
+    @borrows_connection
+    def find_books(self, search_term, columns=('title', 'author'), prefix=False, limit=None):
+        """Return (id, title, author, qty) rows matching the search term"""
+        words = search_term.split()
+        if not words:
+            return []
+
+        if not self.fts_enabled:
+            where = " OR ".join(f"{column} LIKE ?" for column in columns)
+            sql = f"SELECT * FROM book WHERE {where}"
+            params = [f'%{search_term}%'] * len(columns)
+        else:
+            # Quote every word so punctuation is never read as FTS5 syntax
+            star = "*" if prefix else ""
+            phrases = " ".join('"' + word.replace('"', '""') + '"' + star for word in words)
+            match = f"{{{' '.join(columns)}}} : ({phrases})"
+            sql = """
+            SELECT book.* FROM book_fts
+            JOIN book ON book.id = book_fts.rowid
+            WHERE book_fts MATCH ?
+            ORDER BY bm25(book_fts)
+            """
+            params = [match]
+
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchall()
+
+    # Create the trigram index behind typo-tolerant searches
+    def create_trigram_index(self):
+        """Create the trigram FTS5 table and its sync triggers if needed"""
+        exists = self.has_table('book_trigram')
+        try:
+            self.cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS book_trigram USING fts5(
+                title, author, content='book', content_rowid='id', tokenize='trigram'
+            )
+            """)
+        # The trigram tokenizer needs SQLite 3.34 or later
+        except sqlite3.OperationalError as e:
+            print(f"Fuzzy search unavailable: {e}")
+            return False
+
+        self.cursor.executescript("""
+        CREATE TRIGGER IF NOT EXISTS book_trigram_insert AFTER INSERT ON book BEGIN
+            INSERT INTO book_trigram (rowid, title, author)
+            VALUES (new.id, new.title, new.author);
+        END;
+        CREATE TRIGGER IF NOT EXISTS book_trigram_delete AFTER DELETE ON book BEGIN
+            INSERT INTO book_trigram (book_trigram, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+        END;
+        CREATE TRIGGER IF NOT EXISTS book_trigram_update AFTER UPDATE OF id, title, author ON book BEGIN
+            INSERT INTO book_trigram (book_trigram, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+            INSERT INTO book_trigram (rowid, title, author)
+            VALUES (new.id, new.title, new.author);
+        END;
+        """)
+        if not exists:
+            self.cursor.execute("INSERT INTO book_trigram (book_trigram) VALUES ('rebuild')")
+        return True
+
+    # Find books whose title or author is close to the term, typos and all
+    @borrows_connection
+    def fuzzy_find_books(self, search_term, columns=('title', 'author'), limit=10,
+                         min_similarity=0.3, max_postings=1000, candidates=100):
+        """Return up to limit (id, title, author, qty) rows, most similar first"""
+        if not search_term.strip():
+            return []
+        if not self.fuzzy_enabled:
+            return self.find_books(search_term, columns, limit=limit)
+        wanted = trigrams(search_term)
+        target = f"{{{' '.join(columns)}}}"
+
+        def quoted(gram):
+            return '"' + gram.replace('"', '""') + '"'
+
+        # A typo only spoils the trigrams around it, so books sharing the
+        # most of the others are the likely matches. Trigrams found in more
+        # than max_postings books are too common to tell books apart, and
+        # scoring them would touch much of the catalog, so they are only
+        # used as an AND filter. Counting stops at max_postings, which keeps
+        # this step bounded however big the catalog is. The padded trigrams
+        # at either end of the term are skipped: a book only has them when
+        # the word is not the first or last of its title.
+        inner = " ".join(search_term.lower().split())
+        rare, common, missing = [], [], []
+        for gram in wanted:
+            if gram not in inner:
+                continue
+            self.cursor.execute(
+                "SELECT COUNT(*) FROM (SELECT 1 FROM book_trigram WHERE book_trigram MATCH ? LIMIT ?)",
+                (f"{target} : {quoted(gram)}", max_postings + 1)
+            )
+            count = self.cursor.fetchone()[0]
+            if count > max_postings:
+                common.append(gram)
+            elif count:
+                rare.append(gram)
+            else:
+                missing.append(gram)
+
+        # Trigrams no book has were made up by a typo, which points at the
+        # misspelt words. Any trigram touching one of them may be wrong too.
+        suspect = set()
+        for word in re.finditer(r"\S+", inner):
+            if any(gram in f" {word.group()} " for gram in missing):
+                suspect.update(range(word.start() - 1, word.end() + 1))
+        common = {inner[i:i + 3] for i in range(len(inner) - 2)
+                  if inner[i:i + 3] in common and suspect.isdisjoint(range(i, i + 3))}
+
+        # bm25 favours books sharing the most, and the rarest, trigrams;
+        # books holding every common trigram of the correct words are likely
+        # matches too
+        queries = []
+        if rare:
+            queries.append((" OR ".join(map(quoted, rare)), "ORDER BY bm25(book_trigram)"))
+        if common:
+            queries.append((" AND ".join(map(quoted, common)), ""))
+        books = {}
+        for match, order in queries:
+            self.cursor.execute(f"""
+            SELECT book.* FROM book_trigram
+            JOIN book ON book.id = book_trigram.rowid
+            WHERE book_trigram MATCH ?
+            {order}
+            LIMIT ?
+            """, (f"{target} : ({match})", candidates))
+            books.update((book[0], book) for book in self.cursor.fetchall())
+
+        # Rank by the share of the term's trigrams found in the best column,
+        # breaking ties in favour of the closest overall length
+        fields = {'title': 1, 'author': 2}
+        ranked = []
+        for book in books.values():
+            best = (0.0, 0.0)
+            for column in columns:
+                found = trigrams(book[fields[column]])
+                shared = len(wanted & found)
+                best = max(best, (shared / len(wanted), shared / len(wanted | found)))
+            if best[0] >= min_similarity:
+                ranked.append((best, book))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return [book for _, book in ranked[:limit]]
+
+    # Programmatic, prompt-free versions of the menu operations
+    @writes
+    def insert_book(self, book_id, title, author, qty):
+        """Insert one book; return False if the ID is already taken"""
+        self.cursor.execute("SELECT id FROM book WHERE id = ?", (book_id,))
+        if self.cursor.fetchone():
+            return False
+        self.cursor.execute(
+            "INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)",
+            (book_id, title, author, qty)
+        )
+        self._commit([book_id])
+        return True
+
+    @writes
+    def edit_book(self, book_id, title=None, author=None, qty=None):
+        """Change the given fields of one book; return the new row or None"""
+        # Only the fields given are written, in one statement: reading the
+        # row first (possibly from the cache) and writing every column back
+        # would undo a sale committed or queued in between
+        self.cursor.execute(
+            "UPDATE book SET title = COALESCE(?, title), author = COALESCE(?, author), "
+            "qty = COALESCE(?, qty) WHERE id = ?",
+            (title, author, qty, book_id)
+        )
+        if self.cursor.rowcount == 0:
+            return None
+        # Still inside the write transaction, so this is the row just written
+        self.cursor.execute(BOOK_BY_ID_SQL, (book_id,))
+        book = self.cursor.fetchone()
+        self._commit([book_id])
+        return book
+
+    @writes
+    def remove_book(self, book_id):
+        """Delete one book; return False if there was no such book"""
+        self.cursor.execute("DELETE FROM book WHERE id = ?", (book_id,))
+        found = self.cursor.rowcount > 0
+        self._commit([book_id])
+        return found
+
+    # Stock movements are single conditional UPDATEs, so two tills selling the
+    # last copy at once cannot both succeed (no read-modify-write race)
+    @writes
+    def sell(self, book_id, n=1):
+        """Take n copies off the shelf; return False if there are not enough"""
+        if n <= 0:
+            raise ValueError("Quantity sold must be positive")
+        self.cursor.execute(
+            "UPDATE book SET qty = qty - ? WHERE id = ? AND qty >= ?", (n, book_id, n)
+        )
+        sold = self.cursor.rowcount > 0
+        self._commit([book_id] if sold else [])
+        return sold
+
+    @writes
+    def restock(self, book_id, n):
+        """Add n copies; return False if there is no such book"""
+        if n <= 0:
+            raise ValueError("Quantity restocked must be positive")
+        self.cursor.execute("UPDATE book SET qty = qty + ? WHERE id = ?", (n, book_id))
+        found = self.cursor.rowcount > 0
+        self._commit([book_id] if found else [])
+        return found
+
+    @writes
+    def checkout(self, basket):
+        """Sell a whole basket of (book_id, n) lines, or a {book_id: n} dict.
+
+        Either every line is sold or none is. Returns {'ok': bool, 'failed': [...]}
+        where each failure is (book_id, n, reason).
+        """
+        lines = {}
+        failed = []
+        for book_id, n in (basket.items() if isinstance(basket, dict) else basket):
+            if not isinstance(n, int) or n <= 0:
+                failed.append((book_id, n, "quantity must be a positive whole number"))
+                continue
+            lines[int(book_id)] = lines.get(int(book_id), 0) + n
+        if failed or not lines:
+            return {'ok': False, 'failed': failed or [(None, 0, "empty basket")]}
+
+        basket_json = json.dumps({str(book_id): n for book_id, n in lines.items()})
+        self._begin_write()
+        self.cursor.execute("SAVEPOINT checkout")
+        try:
+            if SET_BASED_CHECKOUT:
+                # One statement decrements every line that has enough stock
+                self.cursor.execute("""
+                UPDATE book SET qty = book.qty - line.n
+                FROM (SELECT CAST(key AS INTEGER) AS id, value AS n FROM json_each(?)) AS line
+                WHERE book.id = line.id AND book.qty >= line.n
+                RETURNING book.id
+                """, (basket_json,))
+                sold = {row[0] for row in self.cursor.fetchall()}
+            else:
+                # The same conditional decrement, one line at a time, inside
+                # the same savepoint
+                sold = set()
+                for book_id, n in lines.items():
+                    self.cursor.execute(
+                        "UPDATE book SET qty = qty - ? WHERE id = ? AND qty >= ?",
+                        (n, book_id, n)
+                    )
+                    if self.cursor.rowcount:
+                        sold.add(book_id)
+
+            if len(sold) < len(lines):
+                self.cursor.execute("ROLLBACK TO checkout")
+                self.cursor.execute("RELEASE checkout")
+                # Work out why each missing line could not be sold
+                self.cursor.execute(
+                    "SELECT id, qty FROM book WHERE id IN (SELECT CAST(key AS INTEGER) FROM json_each(?))",
+                    (basket_json,)
+                )
+                stock = dict(self.cursor.fetchall())
+                for book_id, n in lines.items():
+                    if book_id in sold:
+                        continue
+                    if book_id not in stock:
+                        failed.append((book_id, n, "no book with this ID"))
+                    else:
+                        failed.append((book_id, n, f"only {stock[book_id]} in stock"))
+                self._commit()
+                return {'ok': False, 'failed': failed}
+
+            self.cursor.execute("RELEASE checkout")
+        except sqlite3.Error:
+            self.cursor.execute("ROLLBACK TO checkout")
+            self.cursor.execute("RELEASE checkout")
+            raise
+        self._commit(list(lines))
+        return {'ok': True, 'failed': []}
+
+    @borrows_connection
+    def search_by_qty(self, min_qty, max_qty):
+        """Return books with min_qty <= qty <= max_qty, lowest stock first"""
+        self.cursor.execute(QTY_RANGE_SQL, (min_qty, max_qty))
+        return self.cursor.fetchall()
+
+    @borrows_connection
+    def low_stock_books(self):
+        """Return every book below its low-stock threshold, lowest first"""
+        self.cursor.execute(LOW_STOCK_SQL)
+        return self.cursor.fetchall()
+
+    @borrows_connection
+    def list_books(self, after_id=None, limit=50):
+        """Return one page of books in id order, starting after after_id"""
+        # Keyset pagination: seek past the last id instead of using OFFSET
+        if after_id is None:
+            self.cursor.execute("SELECT * FROM book ORDER BY id LIMIT ?", (limit,))
+        else:
+            self.cursor.execute(BOOK_PAGE_SQL, (after_id, limit))
+        return self.cursor.fetchall()
+
     # Add a new book to the data
     def add_book(self):
         """Add a new book to the database"""
@@ -99,18 +1309,10 @@ class BookstoreDB:
                 
             qty = int(input("Enter quantity: "))
             
-            # Check if ID already exists
-            self.cursor.execute("SELECT id FROM book WHERE id = ?", (book_id,))
-            if self.cursor.fetchone():
+            # Insert the new book unless the ID already exists
+            if not self.insert_book(book_id, title, author, qty):
                 print("Error: Please note that a book with this ID already exists.")
                 return False
-                
-            # Insert the new book
-            self.cursor.execute(
-                "INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)",
-                (book_id, title, author, qty)
-            )
-            self.connection.commit()
             print("Book added successfully!")
             return True
         
@@ -119,8 +1321,98 @@ class BookstoreDB:
             print("Error: Please enter valid numeric values for ID and quantity.")
             return False
         except sqlite3.Error as e:
+            self._operation_failed(e)
             print(f"Database error: {e}")
             return False
+
+    # Add many books at once without prompting (e.g. supplier feeds)
+    @writes
+    def add_books(self, books, chunk_size=5000, verbose=True):
+        """Validate, dedupe and insert a batch of books in one transaction.
+
+        Each book is a (id, title, author, qty) tuple or a dict with those keys.
+        Returns a report dict with a (index, id, status, message) entry per row.
+        """
+        start = time.perf_counter()
+        rows = []
+        valid = {}
+
+        # Validate every row and dedupe IDs within the batch
+        for index, book in enumerate(books):
+            try:
+                if isinstance(book, dict):
+                    book_id, title, author, qty = (book['id'], book['title'],
+                                                   book['author'], book['qty'])
+                else:
+                    book_id, title, author, qty = book
+                book_id = int(book_id)
+                qty = int(qty)
+                title = str(title).strip()
+                author = str(author).strip()
+            except (KeyError, TypeError, ValueError):
+                rows.append((index, None, 'invalid', "Expected id, title, author and numeric qty"))
+                continue
+            if not title or not author:
+                rows.append((index, book_id, 'invalid', "Title and author cannot be empty"))
+                continue
+            if book_id in valid:
+                rows.append((index, book_id, 'duplicate', "ID appears more than once in batch"))
+                continue
+            valid[book_id] = (index, (book_id, title, author, qty))
+            rows.append((index, book_id, 'added', ""))
+
+        try:
+            # Find every ID that is already stored with one set-based query
+            existing = set()
+            if valid:
+                self.cursor.execute(
+                    "SELECT id FROM book WHERE id IN (SELECT value FROM json_each(?))",
+                    (json.dumps(list(valid)),)
+                )
+                existing = {row[0] for row in self.cursor.fetchall()}
+            for book_id in existing:
+                index = valid.pop(book_id)[0]
+                rows[index] = (index, book_id, 'exists', "A book with this ID already exists")
+
+            # Insert in chunks, committing once at the end. The savepoint keeps
+            # the batch all-or-nothing inside a transaction or group commit too
+            pending = [book for _, book in valid.values()]
+            self._begin_write()
+            self.cursor.execute("SAVEPOINT add_books")
+            try:
+                for offset in range(0, len(pending), chunk_size):
+                    self.cursor.executemany(
+                        "INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?)",
+                        pending[offset:offset + chunk_size]
+                    )
+                self.cursor.execute("RELEASE add_books")
+            except sqlite3.Error:
+                self.cursor.execute("ROLLBACK TO add_books")
+                self.cursor.execute("RELEASE add_books")
+                raise
+            self._commit(valid)
+
+        except sqlite3.Error as e:
+            self._operation_failed(e)
+            print(f"Database error: {e}")
+            rows = [(index, book_id, 'failed', str(e)) if status == 'added'
+                    else (index, book_id, status, message)
+                    for index, book_id, status, message in rows]
+            pending = []
+
+        elapsed = time.perf_counter() - start
+        report = {
+            'added': len(pending),
+            'rejected': len(rows) - len(pending),
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_second': len(pending) / elapsed if elapsed > 0 else 0.0,
+        }
+        if verbose:
+            print(f"Bulk add: {report['added']} added, {report['rejected']} rejected "
+                  f"in {elapsed:.2f}s ({report['rows_per_second']:.0f} rows/s)")
+        return report
+
     # Update an existing book's information
     def update_book(self):
         """Update an existing book's information"""
@@ -131,8 +1423,7 @@ class BookstoreDB:
             book_id = int(input("Enter the ID of the book to update: "))
             
             # Check if book exists
-            self.cursor.execute("SELECT * FROM book WHERE id = ?", (book_id,))
-            book = self.cursor.fetchone()
+            book = self.get_book(book_id)
             
         
             if not book:
@@ -171,12 +1462,10 @@ class BookstoreDB:
             new_qty = int(new_qty_input) if new_qty_input else book[3]
             
             # Update the book
-            self.cursor.execute(
-                "UPDATE book SET title = ?, author = ?, qty = ? WHERE id = ?",
-                (new_title, new_author, new_qty, book_id)
-            )
+            if not self.edit_book(book_id, new_title, new_author, new_qty):
+                print("Error: No book found with that ID.")
+                return False
             # If the update is successful
-            self.connection.commit()
             print("Book updated successfully!")
             return True
 
@@ -185,6 +1474,7 @@ class BookstoreDB:
             print("Error: Please enter a valid numeric value for quantity.")
             return False
         except sqlite3.Error as e:
+            self._operation_failed(e)
             print(f"Database error: {e}")
             return False
 
@@ -197,22 +1487,22 @@ class BookstoreDB:
             book_id = int(input("Enter the ID of the book to delete: "))
             
             # Check if book exists
-            self.cursor.execute("SELECT title, author FROM book WHERE id = ?", (book_id,))
-            book = self.cursor.fetchone()
+            book = self.get_book(book_id)
             
             if not book:
                 print("Error: No book found with that ID.")
                 return False
                 
             # Enhanced "Are you sure?" prompt
-            confirm = input(f"Are you sure you want to delete '{book[0]}' by {book[1]}? This cannot be undone. (y/n): ")
+            confirm = input(f"Are you sure you want to delete '{book[1]}' by {book[2]}? This cannot be undone. (y/n): ")
             if confirm.lower() != 'y':
                 print("Deletion cancelled.")
                 return False
                 
             # Delete the book
-            self.cursor.execute("DELETE FROM book WHERE id = ?", (book_id,))
-            self.connection.commit()
+            if not self.remove_book(book_id):
+                print("Error: No book found with that ID.")
+                return False
             print("Book deleted successfully!")
             return True
             
@@ -220,6 +1510,7 @@ class BookstoreDB:
             print("Error: Please enter a valid numeric value for book ID.")
             return False
         except sqlite3.Error as e:
+            self._operation_failed(e)
             print(f"Database error: {e}")
             return False
 
@@ -232,51 +1523,38 @@ class BookstoreDB:
         print("3. Search by Title or Author")
         print("4. Search by ID")
         print("5. Search by Quantity Range")
-        print("6. Search for Low Stock (Qty < 5)")
+        print(f"6. Search for Low Stock (below threshold, default {DEFAULT_LOW_STOCK})")
         
         try:
 
             # Get search option from user
             search_option = input("\nSelect search option (1-6): ").strip()
             
-            if search_option == '1':
-                search_term = input("Enter title to search for: ").strip()
-                if not search_term:
-                    print("Please enter a search term.")
-                    return False
-                self.cursor.execute(
-                    "SELECT * FROM book WHERE title LIKE ?",
-                    (f'%{search_term}%',)
-                )
-                
-            elif search_option == '2':
-                search_term = input("Enter author to search for: ").strip()
-                if not search_term:
-                    print("Please enter a search term.")
-                    return False
-                self.cursor.execute(
-                    "SELECT * FROM book WHERE author LIKE ?",
-                    (f'%{search_term}%',)
-                )
-                
-            elif search_option == '3':
-                search_term = input("Enter title or author to search for: ").strip()
+            if search_option in ('1', '2', '3'):
+                prompts = {
+                    '1': ("Enter title to search for: ", ('title',)),
+                    '2': ("Enter author to search for: ", ('author',)),
+                    '3': ("Enter title or author to search for: ", ('title', 'author')),
+                }
+                prompt, columns = prompts[search_option]
+                search_term = input(prompt).strip()
                 if not search_term:
                     print("Please enter a search term.")
                     return False
-                self.cursor.execute(
-                    "SELECT * FROM book WHERE title LIKE ? OR author LIKE ?",
-                    (f'%{search_term}%', f'%{search_term}%')
-                )
+                prefix = input("Match words by prefix, e.g. 'pot' finds 'Potter'? (y/n): ")
+                results = self.find_books(search_term, columns, prefix.lower() == 'y')
+                # Nothing matched exactly, so the term may be misspelt
+                if not results and self.fuzzy_enabled:
+                    results = self.fuzzy_find_books(search_term, columns)
+                    if results:
+                        print("No exact matches. Showing the closest titles instead.")
                 
             elif search_option == '4':
                 # Search by ID
                 try:
                     search_id = int(input("Enter book ID to search for: "))
-                    self.cursor.execute(
-                        "SELECT * FROM book WHERE id = ?",
-                        (search_id,)
-                    )
+                    book = self.get_book(search_id)
+                    results = [book] if book else []
                 except ValueError:
                     print("Error: Please enter a valid numeric ID.")
                     return False
@@ -286,82 +1564,81 @@ class BookstoreDB:
                 try:
                     min_qty = int(input("Enter minimum quantity: "))
                     max_qty = int(input("Enter maximum quantity: "))
-                    self.cursor.execute(
-                        "SELECT * FROM book WHERE qty BETWEEN ? AND ? ORDER BY qty ASC",
-                        (min_qty, max_qty)
-                    )
+                    results = self.search_by_qty(min_qty, max_qty)
                 except ValueError:
                     print("Error: Please enter valid numeric values for quantity range.")
                     return False
                 
             elif search_option == '6':
                 # Search for low stock (quantity less than 5)
-                self.cursor.execute(
-                    "SELECT * FROM book WHERE qty < 5 ORDER BY qty ASC"
-                )
-                print("Searching for low stock items (qty < 5)...")
+                results = self.low_stock_books()
+                print("Searching for low stock items...")
                 
             else:
                 print("Invalid search option.")
                 return False
                 
-            results = self.cursor.fetchall()
-            
             if not results:
                 print("No books found matching your search.")
                 return False
                 
             print(f"\nFound {len(results)} matching book(s):")
-            print("-" * 70)
-            print(f"{'ID':<6} {'Title':<35} {'Author':<20} {'Qty':<5}")
-            print("-" * 70)
 
             # Display search results
-            for book in results:
-                # Truncate long titles for better display
-                title = book[1] if len(book[1]) <= 35 else book[1][:32] + "..."
-                # Add low stock warning for items with quantity less than 5
-                qty_display = f"{book[3]} ***" if book[3] < 5 else f"{book[3]}"
-                print(f"{book[0]:<6} {title:<35} {book[2]:<20} {qty_display:<5}")
-                
+            renderer = BookRenderer(low_ids=self.low_stock_ids())
+            renderer.start()
+            renderer.rows(results)
+            renderer.finish()
             return True
             
         except sqlite3.Error as e:
             print(f"Database error during search: {e}")
             return False
             
-    def display_all_books(self):
+    # Walk the catalog in id order, one bounded page at a time
+    def iter_book_pages(self, page_size=50):
+        """Yield lists of at most page_size books using keyset pagination"""
+        last_id = None
+        with self.pool.connection():
+            while True:
+                page = self.list_books(last_id, page_size)
+                if not page:
+                    return
+                yield page
+                if len(page) < page_size:
+                    return
+                last_id = page[-1][0]
+
+    @borrows_connection
+    def display_all_books(self, page_size=50, pause=True):
         """Display all books in the database with low stock alerts"""
         try:
-            self.cursor.execute("SELECT * FROM book ORDER BY id")
-            books = self.cursor.fetchall()
-            
-            if not books:
+            # The registry already knows which books are low, so no counting pass
+            low_ids = self.low_stock_ids()
+            renderer = BookRenderer(low_ids=low_ids)
+            shown = 0
+            for page in self.iter_book_pages(page_size):
+                # Ask before every page after the first
+                if shown and pause:
+                    renderer.flush()
+                    more = input(f"\n-- {shown} book(s) shown. Press Enter for more or 'q' to stop: ")
+                    if more.strip().lower() == 'q':
+                        break
+
+                if not shown:
+                    renderer.start('All Books in Database')
+                renderer.rows(page)
+                shown += len(page)
+            renderer.flush()
+
+            if not shown:
                 print("No books in the database.")
                 return False
-                
-            print(f"\n{'All Books in Database':^70}")
-            print("-" * 70)
-            print(f"{'ID':<6} {'Title':<35} {'Author':<20} {'Qty':<5}")
-            print("-" * 70)
-
-            # Count low stock items
-            low_stock_count = 0
-            for book in books:
-
-                # Truncate long titles for better display
-                title = book[1] if len(book[1]) <= 35 else book[1][:32] + "..."
-
-                # Add low stock warning for items with quantity less than 5
-                qty_display = f"{book[3]} ***" if book[3] < 5 else f"{book[3]}"
-                if book[3] < 5:
-                    low_stock_count += 1
-                print(f"{book[0]:<6} {title:<35} {book[2]:<20} {qty_display:<5}")
-            
+
             # Display low stock summary
-            if low_stock_count > 0:
+            if low_ids:
                 print("\n*** LOW STOCK ALERT ***")
-                print(f"There are {low_stock_count} book(s) with less than 5 copies in stock.")
+                print(f"There are {len(low_ids)} book(s) below their low-stock threshold.")
                 print("Please consider restocking these items soon.")
                 
             return True
@@ -370,6 +1647,31 @@ class BookstoreDB:
             print(f"Database error: {e}")
             return False
 
+    # Copy the database to a standalone file that can be opened immutable
+    @borrows_connection
+    def save_snapshot(self, path):
+        """Write a consistent copy of the database to path"""
+        target = sqlite3.connect(path)
+        try:
+            self.connection.backup(target)
+            # Immutable readers ignore -wal files, so keep everything in one file
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+
+    # Write the catalog, or only the low-stock books, to a file in one pass
+    @borrows_connection
+    def write_report(self, stream, fmt='table', low_stock_only=False, page_size=10000):
+        """Render books to stream as a table, CSV or JSON; returns the row count"""
+        low_ids = self.low_stock_ids()
+        renderer = BookRenderer(stream, fmt, low_ids)
+        renderer.start('Low Stock Books' if low_stock_only else 'All Books in Database')
+        pages = [self.low_stock_books()] if low_stock_only else self.iter_book_pages(page_size)
+        for page in pages:
+            renderer.rows(page)
+        renderer.finish()
+        return renderer.count
+
 def display_menu():
     """Display the main menu options"""
     print("\n" + "=" * 42)
@@ -380,31 +1682,59 @@ def display_menu():
     print("3. Delete book")
     print("4. Search books")
     print("5. Display all books")
+    print("6. Set low-stock threshold")
+    print("7. Sell or restock")
     print("0. Exit")
     print("=" * 50)
 
-def main():
-    """Main function to run the bookstore application"""
-    print("Initializing Bookstore Database System...")
-    
-    # Create database instance
-    bookstore = BookstoreDB()
-    
-    # Connect to database
-    if not bookstore.connect():
-        print("Failed to connect to database. Exiting.")
-        return
-        
-    # Initialize database with tables and default data
-    if not bookstore.initialize_database():
-        print("Failed to initialize database. Exiting.")
-        bookstore.disconnect()
-        return
-        
-    # Main program loop
+def build_parser():
+    """Build the command line parser; with no command the menu is started"""
+    parser = argparse.ArgumentParser(description="Bookstore Database System")
+    parser.add_argument('--db', default='ebookstore.db', help="database file (default: ebookstore.db)")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="record per-statement SQL timings and write them to FILE at exit "
+                             "(.json, or .prom for Prometheus text)")
+    parser.add_argument('--read-only', action='store_true', help="open the database with mode=ro")
+    parser.add_argument('--immutable', action='store_true',
+                        help="open a snapshot file read-only without any locking")
+    parser.add_argument('--profile', choices=sorted(TUNING_PROFILES),
+                        help="connection tuning (default: reporting for report, else default)")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('check-plans', help="show and verify the query plans of the canned queries")
+
+    low_stock_parser = commands.add_parser('low-stock', help="verify the low-stock registry against the book table")
+    low_stock_parser.add_argument('--rebuild', action='store_true', help="recompute the registry first")
+
+    import_parser = commands.add_parser('import', help="load books from a CSV or JSONL file")
+    import_parser.add_argument('file')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], help="default: from the file extension")
+    import_parser.add_argument('--chunk-size', type=int, default=10000, help="books per transaction")
+    import_parser.add_argument('--resume', action='store_true', help="carry on from the last checkpoint")
+
+    serve_parser = commands.add_parser('serve', help="run the local HTTP/JSON service")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--workers', type=int, default=16, help="worker threads (and connections)")
+    serve_parser.add_argument('--verbose', action='store_true', help="log every request")
+
+    report_parser = commands.add_parser('report', help="write the catalog as a table, CSV or JSON")
+    report_parser.add_argument('file', help="output file, or - for the screen")
+    report_parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table')
+    report_parser.add_argument('--low-stock', action='store_true', help="only books below their threshold")
+
+    snapshot_parser = commands.add_parser('snapshot', help="save a standalone copy for immutable reads")
+    snapshot_parser.add_argument('file')
+
+    export_parser = commands.add_parser('export', help="write every book to a CSV or JSONL file")
+    export_parser.add_argument('file')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'], help="default: from the file extension")
+    return parser
+
+def run_menu(bookstore):
+    """Run the interactive menu until the clerk exits"""
     while True:
         display_menu()
-        choice = input("Please enter your choice (0-5): ").strip()
+        choice = input("Please enter your choice (0-7): ").strip()
         
         if choice == '0':
             # Add exit confirmation
@@ -431,15 +1761,96 @@ def main():
         elif choice == '5':
             bookstore.display_all_books()
             
+        elif choice == '6':
+            bookstore.set_threshold()
+            
+        elif choice == '7':
+            bookstore.adjust_stock()
+            
         else:
-            print("Wrong choice. Please enter a number between 0 and 5.")
+            print("Wrong choice. Please enter a number between 0 and 7.")
 
 
         # Wait for user input before continuing
         input("\nPress Enter to continue...")
+
+def main(argv=None):
+    """Main function to run the bookstore application"""
+    args = build_parser().parse_args(argv)
+    if args.command == 'report' and args.file == '-':
+        # The report itself goes to stdout, so every status message,
+        # including those printed while the database opens, goes to stderr
+        out = sys.stdout
+        with redirect_stdout(sys.stderr):
+            run(args, out)
+    else:
+        run(args, sys.stdout)
+
+def run(args, out):
+    """Open the database and carry out the command; out receives report data"""
+    if args.trace:
+        sql_trace.enable(args.trace)
+    print("Initializing Bookstore Database System...")
+    
+    # Create database instance
+    profile = args.profile or ('reporting' if args.command == 'report' else 'default')
+    bookstore = BookstoreDB(args.db, pool_size=args.workers if args.command == 'serve' else 5,
+                            read_only=args.read_only, immutable=args.immutable, profile=profile)
+    
+    # Connect to database
+    if not bookstore.connect():
+        print("Failed to connect to database. Exiting.")
+        return
+        
+    # Initialize database with tables and default data
+    if not bookstore.initialize_database():
+        print("Failed to initialize database. Exiting.")
+        bookstore.disconnect()
+        return
+
+    # Set by commands that stop part way, so scripts see a non-zero exit
+    failed = False
+    if args.command == 'check-plans':
+        bookstore.check_query_plans(verbose=True)
+        print("All canned queries use their indexes.")
+    elif args.command == 'low-stock':
+        if args.rebuild:
+            bookstore.rebuild_low_stock()
+            print("Low-stock registry rebuilt.")
+        mismatched = bookstore.verify_low_stock()
+        if mismatched:
+            print(f"Low-stock registry is out of date for book id(s): {mismatched[:20]}")
+        else:
+            print(f"Low-stock registry OK: {bookstore.low_stock_count()} book(s) low on stock.")
+    elif args.command == 'import':
+        import bookstore_io
+        if bookstore_io.import_books(bookstore, args.file, args.format, args.chunk_size,
+                                     args.resume) is None:
+            failed = True
+    elif args.command == 'serve':
+        import bookstore_server
+        bookstore_server.serve(bookstore, args.host, args.port, args.workers, args.verbose)
+    elif args.command == 'report':
+        start = time.perf_counter()
+        if args.file == '-':
+            bookstore.write_report(out, args.format, args.low_stock)
+        else:
+            with open(args.file, 'w', newline='', encoding='utf-8') as f:
+                count = bookstore.write_report(f, args.format, args.low_stock)
+            print(f"Wrote {count} book(s) to {args.file} in {time.perf_counter() - start:.1f}s.")
+    elif args.command == 'snapshot':
+        bookstore.save_snapshot(args.file)
+        print(f"Snapshot saved to {args.file}.")
+    elif args.command == 'export':
+        import bookstore_io
+        bookstore_io.export_books(bookstore, args.file, args.format)
+    else:
+        run_menu(bookstore)
     
     # Clean up
     bookstore.disconnect()
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
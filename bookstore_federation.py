@@ -0,0 +1,247 @@
+# Chain-wide views over several branch databases, without copying any data
+#
+# Every branch keeps its own file and its own BookstoreDB. Queries are sent
+# to all branches at once, and each branch hands back rows in id order, so
+# stock and low-stock results can be merged as they arrive. Search results
+# are ranked instead, and are merged by each book's best rank.
+#
+# Run with: python bookstore_federation.py -b north=north.db -b south=south.db stock
+import argparse
+import heapq
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bookstore_clerk import BookstoreDB
+
+# Marks the end of a branch's rows in its queue
+_DONE = object()
+
+
+class BranchFederation:
+    """Federated stock, search and low-stock queries over branch databases"""
+
+    def __init__(self, branches, workers=None, prefetch=4):
+        # branches maps a branch name to its database file
+        self.paths = dict(branches)
+        self.prefetch = prefetch
+        self.branches = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers or max(len(self.paths), 1),
+                                            thread_name_prefix='branch')
+
+    # Open every branch in parallel; a missing file is an error, not a new branch
+    def open(self):
+        """Connect to every branch and bring its schema up to date"""
+        missing = [path for path in self.paths.values() if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"No branch database at {', '.join(missing)}")
+
+        def open_branch(path):
+            bookstore = BookstoreDB(path, pool_size=2)
+            if not bookstore.connect() or not bookstore.initialize_database():
+                raise ConnectionError(f"Could not open branch database {path}")
+            return bookstore
+
+        futures = {name: self._executor.submit(open_branch, path) for name, path in self.paths.items()}
+        opened, error = {}, None
+        for name, future in futures.items():
+            try:
+                opened[name] = future.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            # Do not leave the branches that did open connected
+            for bookstore in opened.values():
+                bookstore.disconnect()
+            raise error
+        self.branches = opened
+        return self
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for bookstore in self.branches.values():
+            bookstore.disconnect()
+        self.branches = {}
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Run pages(bookstore) for one branch on its own thread, a few pages ahead
+    def _stream(self, name, pages):
+        """Start fetching the branch's pages now; returns (rows, stop).
+
+        rows yields the branch's rows as the producer thread delivers them,
+        and stop() ends the producer early.
+        """
+        bookstore = self.branches[name]
+        buffer = queue.Queue(maxsize=self.prefetch)
+        cancelled = threading.Event()
+
+        # The producer waits on a slow reader, so it gets a thread of its
+        # own: on the shared pool, two open streams could block each other
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for page in pages(bookstore):
+                    if not put(page):
+                        return
+            except Exception as e:
+                put(e)
+            put(_DONE)
+
+        def rows():
+            try:
+                while True:
+                    page = buffer.get()
+                    if page is _DONE:
+                        return
+                    if isinstance(page, Exception):
+                        raise page
+                    yield from page
+            finally:
+                # Stop the producer if the reader gave up early
+                cancelled.set()
+
+        # Started here rather than on the first read, so every branch's
+        # query is under way before the merge waits on any of them
+        threading.Thread(target=produce, name=f"branch-{name}", daemon=True).start()
+        return rows(), cancelled.set
+
+    # Combine per-branch rows (each in id order) into one row per book
+    def _merge(self, pages, low=None):
+        """Yield dicts with the book, its qty in each branch and the total"""
+        def tagged(name, rows):
+            for book in rows:
+                yield book[0], name, book
+
+        streams = {name: self._stream(name, pages) for name in self.branches}
+        try:
+            merged = heapq.merge(*(tagged(name, rows) for name, (rows, _) in streams.items()),
+                                 key=lambda item: item[0])
+            for book_id, rows in itertools.groupby(merged, key=lambda item: item[0]):
+                rows = list(rows)
+                _, _, first = rows[0]
+                qty = {name: book[3] for _, name, book in rows}
+                row = {'id': book_id, 'title': first[1], 'author': first[2],
+                       'qty': qty, 'total': sum(qty.values())}
+                if low is not None:
+                    row['low'] = sorted(low.get(book_id, ()))
+                yield row
+        finally:
+            for _, stop in streams.values():
+                stop()
+
+    def stock(self, page_size=1000):
+        """Stream every title in the chain with per-branch quantities"""
+        return self._merge(lambda bookstore: bookstore.iter_book_pages(page_size))
+
+    def search(self, search_term, columns=('title', 'author'), prefix=False, fuzzy=False,
+               limit=None):
+        """Search every branch at once; returns rows best match first"""
+        def find(bookstore):
+            if fuzzy:
+                return bookstore.fuzzy_find_books(search_term, columns, limit or 10)
+            return bookstore.find_books(search_term, columns, prefix, limit)
+
+        futures = {name: self._executor.submit(find, bookstore)
+                   for name, bookstore in self.branches.items()}
+        # Scores from different branches are not comparable, so a book is
+        # placed by its best position in any branch's ranking
+        rows, best = {}, {}
+        for name, future in futures.items():
+            for rank, book in enumerate(future.result()):
+                row = rows.get(book[0])
+                if row is None:
+                    row = rows[book[0]] = {'id': book[0], 'title': book[1], 'author': book[2],
+                                           'qty': {}, 'total': 0}
+                    best[book[0]] = rank
+                row['qty'][name] = book[3]
+                row['total'] += book[3]
+                best[book[0]] = min(best[book[0]], rank)
+        ranked = sorted(rows.values(), key=lambda row: (best[row['id']], row['id']))
+        if fuzzy or limit:
+            ranked = ranked[:limit or 10]
+        return ranked
+
+    def low_stock(self, chunk_size=1000):
+        """Stream books below threshold in any branch, with their qty everywhere"""
+        # First ask each branch which of its books are low...
+        futures = {name: self._executor.submit(bookstore.low_stock_ids)
+                   for name, bookstore in self.branches.items()}
+        low = {}
+        for name, future in futures.items():
+            for book_id in future.result():
+                low.setdefault(book_id, set()).add(name)
+
+        # ...then fetch those books from every branch, so the totals are complete
+        ids = sorted(low)
+
+        def pages(bookstore):
+            for start in range(0, len(ids), chunk_size):
+                yield bookstore.get_books(ids[start:start + chunk_size])
+        return self._merge(pages, low)
+
+
+# Print chain-wide rows as a table, one quantity column per branch
+def print_rows(rows, branches):
+    names = list(branches)
+    print(f"{'ID':<8} {'Title':<35} " + " ".join(f"{name[:8]:>8}" for name in names) + f" {'Total':>8}")
+    count = 0
+    for row in rows:
+        title = row['title'] if len(row['title']) <= 35 else row['title'][:32] + "..."
+        cells = []
+        for name in names:
+            qty = row['qty'].get(name)
+            cell = '-' if qty is None else str(qty)
+            if name in row.get('low', ()):
+                cell += '*'
+            cells.append(f"{cell:>8}")
+        print(f"{row['id']:<8} {title:<35} " + " ".join(cells) + f" {row['total']:>8}")
+        count += 1
+    print(f"{count} title(s)." + (" * = below threshold in that branch." if count else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chain-wide views over branch databases")
+    parser.add_argument('-b', '--branch', action='append', required=True, metavar='NAME=FILE',
+                        help="branch name and database file; repeat for every branch")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stock', help="every title with its quantity in each branch")
+    search_parser = commands.add_parser('search', help="search titles and authors in every branch")
+    search_parser.add_argument('term')
+    search_parser.add_argument('--fuzzy', action='store_true', help="tolerate typos")
+    commands.add_parser('low-stock', help="titles below threshold in any branch")
+    args = parser.parse_args(argv)
+
+    branches = {}
+    for branch in args.branch:
+        name, sep, path = branch.partition('=')
+        if not sep:
+            parser.error(f"expected NAME=FILE, got {branch!r}")
+        branches[name] = path
+
+    with BranchFederation(branches) as federation:
+        if args.command == 'stock':
+            rows = federation.stock()
+        elif args.command == 'search':
+            rows = federation.search(args.term, fuzzy=args.fuzzy)
+        else:
+            rows = federation.low_stock()
+        print_rows(rows, branches)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Streaming CSV / JSONL import and export for the book table
+import csv
+import io
+import json
+import os
+import time
+
+FIELDS = ['id', 'title', 'author', 'qty']
+# add_books statuses for rows that are bad data, not a database failure
+REJECTED = ('invalid', 'duplicate', 'exists')
+
+
+# Work out the file format from the option or the file extension
+def detect_format(path, fmt=None):
+    """Return 'csv' or 'jsonl'"""
+    if fmt:
+        return fmt
+    return 'jsonl' if path.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+# Read one book per line (JSONL) or row (CSV) without loading the file
+def iter_records(path, fmt, start=0):
+    """Yield (byte offset after the record, record) pairs, starting at byte start"""
+    with open(path, 'rb') as f:
+        header = None
+        if fmt == 'csv':
+            first = f.readline()
+            header = next(csv.reader([first.decode('utf-8-sig')]))
+            start = max(start, f.tell())
+        f.seek(start)
+        offset = start
+
+        # Count the bytes of every line handed on, so we always know where we are
+        def lines():
+            nonlocal offset
+            for line in f:
+                offset += len(line)
+                yield line.decode('utf-8')
+
+        if fmt == 'csv':
+            # csv.reader only pulls the lines it needs, so offset stays exact
+            for row in csv.reader(lines()):
+                if row:
+                    yield offset, dict(zip(header, row))
+        else:
+            for line in lines():
+                if line.strip():
+                    try:
+                        yield offset, json.loads(line)
+                    except json.JSONDecodeError:
+                        yield offset, None
+
+
+# Checkpoints let an interrupted import carry on where it stopped
+def load_checkpoint(path):
+    checkpoint = path + '.checkpoint'
+    if not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, state):
+    # Write to a temp file first so a crash never leaves half a checkpoint
+    checkpoint = path + '.checkpoint'
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def import_books(bookstore, path, fmt=None, chunk_size=10000, resume=False):
+    """Stream books from a CSV or JSONL file into the database in chunks.
+
+    Returns the import totals, or None if a database error stopped it.
+    """
+    fmt = detect_format(path, fmt)
+    state = {'offset': 0, 'read': 0, 'added': 0, 'rejected': 0}
+    if resume:
+        saved = load_checkpoint(path)
+        if saved:
+            state = saved
+            print(f"Resuming import after {state['read']} record(s).")
+
+    start = time.perf_counter()
+    session_read = 0
+
+    # Each chunk is added in its own transaction, then checkpointed
+    def flush(chunk, offset):
+        nonlocal session_read
+        report = bookstore.add_books(chunk, chunk_size, verbose=False)
+        statuses = [row[2] for row in report['rows']]
+        if 'failed' in statuses:
+            # The chunk was rolled back; keep the last checkpoint so that
+            # --resume tries it again
+            print(f"Import stopped after {state['read']} record(s): the database "
+                  f"rejected a chunk. Fix the problem and run again with --resume.")
+            return False
+        state['offset'] = offset
+        state['read'] += len(chunk)
+        state['added'] += report['added']
+        state['rejected'] += sum(status in REJECTED for status in statuses)
+        session_read += len(chunk)
+        save_checkpoint(path, state)
+        elapsed = time.perf_counter() - start
+        print(f"  {state['read']} read, {state['added']} added, {state['rejected']} rejected "
+              f"({session_read / elapsed if elapsed else 0:.0f} rows/s)")
+        return True
+
+    chunk = []
+    offset = state['offset']
+    for offset, record in iter_records(path, fmt, state['offset']):
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            if not flush(chunk, offset):
+                return None
+            chunk = []
+    if chunk and not flush(chunk, offset):
+        return None
+
+    # The import is complete, so there is nothing left to resume
+    if os.path.exists(path + '.checkpoint'):
+        os.remove(path + '.checkpoint')
+    print(f"Import finished: {state['added']} added, {state['rejected']} rejected "
+          f"in {time.perf_counter() - start:.1f}s.")
+    return state
+
+
+def export_books(bookstore, path, fmt=None, batch_size=10000):
+    """Stream the book table to a CSV or JSONL file"""
+    fmt = detect_format(path, fmt)
+    start = time.perf_counter()
+    written = 0
+
+    with bookstore.pool.connection(), open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(FIELDS)
+
+        # SQLite hands rows over as they are stepped, so only a batch is in memory
+        cursor = bookstore.cursor
+        cursor.execute("SELECT id, title, author, qty FROM book ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                buffer = io.StringIO()
+                for row in rows:
+                    buffer.write(json.dumps(dict(zip(FIELDS, row))) + '\n')
+                f.write(buffer.getvalue())
+            written += len(rows)
+            elapsed = time.perf_counter() - start
+            print(f"  {written} exported ({written / elapsed if elapsed else 0:.0f} rows/s)")
+
+    print(f"Export finished: {written} book(s) written to {path}.")
+    return written
@@ -0,0 +1,95 @@
+# Render book listings as a table, CSV or JSON onto any text stream
+import csv
+import io
+import sys
+from json.encoder import encode_basestring_ascii as quote
+
+FORMATS = ('table', 'csv', 'json')
+
+# Table layout used by the menu; long titles are cut to fit their column
+TABLE_WIDTH = 70
+TITLE_WIDTH = 35
+LOW_STOCK_MARKER = " ***"
+ROW_FORMAT = f"{{:<6}} {{:<{TITLE_WIDTH}}} {{:<20}} {{:<5}}\n".format
+
+
+class BookRenderer:
+    """Writes book rows to a stream, collecting output into large writes.
+
+    Call rows() any number of times between start() and finish(). Nothing
+    is guaranteed to reach the stream before flush() or finish(), so flush
+    before prompting the user.
+    """
+
+    def __init__(self, stream=None, fmt='table', low_ids=(), buffer_size=1 << 20):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format {fmt!r}; use one of {', '.join(FORMATS)}")
+        self.stream = stream if stream is not None else sys.stdout
+        self.fmt = fmt
+        self.low_ids = low_ids
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._parts = []
+        self._size = 0
+
+    # Buffering
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.stream.write("".join(self._parts))
+            self._parts = []
+            self._size = 0
+        self.stream.flush()
+
+    # Output
+    def start(self, heading=None):
+        """Write whatever comes before the first row"""
+        if self.fmt == 'table':
+            if heading:
+                self.write(f"\n{heading:^{TABLE_WIDTH}}\n")
+            rule = "-" * TABLE_WIDTH
+            self.write(f"{rule}\n{'ID':<6} {'Title':<{TITLE_WIDTH}} {'Author':<20} {'Qty':<5}\n{rule}\n")
+        elif self.fmt == 'csv':
+            self.write("id,title,author,qty,low_stock\r\n")
+        else:
+            self.write("[")
+
+    def rows(self, books):
+        """Write a batch of (id, title, author, qty) rows"""
+        low_ids = self.low_ids
+        if self.fmt == 'table':
+            # Long titles are truncated, and books below their threshold
+            # get the low stock marker after the quantity
+            text = "".join([
+                ROW_FORMAT(book_id,
+                           title if len(title) <= TITLE_WIDTH else title[:TITLE_WIDTH - 3] + "...",
+                           author,
+                           f"{qty}{LOW_STOCK_MARKER}" if book_id in low_ids else qty)
+                for book_id, title, author, qty in books
+            ])
+        elif self.fmt == 'csv':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows((*book, int(book[0] in low_ids)) for book in books)
+            text = buffer.getvalue()
+        else:
+            # Same output as json.dumps per row, without building a dict for each
+            text = ",".join(
+                f'\n{{"id": {book[0]}, "title": {quote(book[1])}, "author": {quote(book[2])}, '
+                f'"qty": {book[3]}, "low_stock": {"true" if book[0] in low_ids else "false"}}}'
+                for book in books
+            )
+            if self.count and text:
+                text = "," + text
+        self.count += len(books)
+        self.write(text)
+
+    def finish(self):
+        """Write whatever comes after the last row and flush"""
+        if self.fmt == 'json':
+            self.write("\n]\n" if self.count else "]\n")
+        self.flush()
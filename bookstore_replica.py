@@ -0,0 +1,266 @@
+# Read replica of the book table, kept current from the primary's change log
+#
+# The replica starts as a snapshot of the primary (SQLite backup API), then
+# the applier tails book_changes and threshold_changes and replays every
+# change after the snapshot. If the primary pruned changes the replica has
+# not applied yet, the applier notices the gap and takes a new snapshot. The primary is only ever read, through a read-only connection,
+# and in WAL mode readers never block the tills.
+#
+# Run with: python bookstore_replica.py --primary ebookstore.db --replica replica.db
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from collections import deque
+
+from bookstore_clerk import BookstoreDB
+
+CHANGES_SQL = """
+SELECT seq, op, book_id, title, author, qty, changed_at FROM book_changes
+WHERE seq > ? ORDER BY seq LIMIT ?
+"""
+
+THRESHOLD_CHANGES_SQL = """
+SELECT seq, book_id, threshold, changed_at FROM threshold_changes
+WHERE seq > ? ORDER BY seq LIMIT ?
+"""
+
+# Highest seq a log has ever handed out, even if those rows were pruned since
+LAST_SEQ_SQL = "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0)"
+
+
+class ReplicaApplier:
+    """Copies changes from a primary bookstore database to a replica file"""
+
+    def __init__(self, primary_path, replica_path, batch_size=1000, poll_interval=0.1,
+                 lag_window=10000):
+        self.primary_path = primary_path
+        self.replica_path = replica_path
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.primary = None
+        self.replica = None
+        self.applied_seq = 0
+        self.applied_threshold_seq = 0
+        self.applied = 0
+        # Seconds between a change committing on the primary and on the
+        # replica, for the most recent lag_window changes
+        self.lag_samples = deque(maxlen=lag_window)
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Open both files, taking a snapshot first if the replica is new
+    def open(self):
+        """Connect to the primary (read-only) and the replica"""
+        # Quoted like ConnectionPool._open: a '#' or '?' in the path would
+        # otherwise end it early and drop mode=ro
+        uri = f"file:{urllib.parse.quote(os.path.abspath(self.primary_path))}?mode=ro"
+        self.primary = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.replica = sqlite3.connect(self.replica_path, check_same_thread=False)
+        self.replica.execute("PRAGMA journal_mode = WAL")
+
+        try:
+            self._load_state()
+        except sqlite3.OperationalError:
+            # A new replica, or one from before thresholds were replicated
+            self.snapshot()
+            self._load_state()
+        return self
+
+    def _load_state(self):
+        self.applied_seq, self.applied_threshold_seq = self.replica.execute(
+            "SELECT seq, threshold_seq FROM replica_state").fetchone()
+
+    def snapshot(self):
+        """Copy the whole primary into the replica and remember its position"""
+        # The backup reads one consistent version of the primary, and
+        # replaces everything the replica held before
+        self.primary.backup(self.replica)
+        seq = self.replica.execute(LAST_SEQ_SQL, ('book_changes',)).fetchone()[0]
+        threshold_seq = self.replica.execute(LAST_SEQ_SQL, ('threshold_changes',)).fetchone()[0]
+
+        # The replica only replays the primary's logs, it does not keep its
+        # own. Threshold deletes arrive through threshold_changes in their own
+        # order, so deleting a book must not also delete its threshold here.
+        self.replica.executescript("""
+        DROP TRIGGER IF EXISTS book_changes_insert;
+        DROP TRIGGER IF EXISTS book_changes_update;
+        DROP TRIGGER IF EXISTS book_changes_delete;
+        DROP TRIGGER IF EXISTS threshold_changes_insert;
+        DROP TRIGGER IF EXISTS threshold_changes_update;
+        DROP TRIGGER IF EXISTS threshold_changes_delete;
+        DELETE FROM book_changes;
+        DELETE FROM threshold_changes;
+        DROP TRIGGER IF EXISTS low_stock_delete;
+        CREATE TRIGGER low_stock_delete AFTER DELETE ON book BEGIN
+            DELETE FROM low_stock WHERE book_id = old.id;
+        END;
+        CREATE TABLE replica_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL,
+            threshold_seq INTEGER NOT NULL
+        );
+        """)
+        self.replica.execute("INSERT INTO replica_state (id, seq, threshold_seq) VALUES (1, ?, ?)",
+                             (seq, threshold_seq))
+        self.replica.commit()
+        print(f"Replica {self.replica_path} created from a snapshot at change {seq}.")
+
+    # Replay one batch of changes; returns how many were applied
+    def apply_once(self):
+        """Apply the next batch of changes from the primary"""
+        # Each read is its own short snapshot, so the primary can keep
+        # checkpointing its WAL
+        changes = self.primary.execute(CHANGES_SQL, (self.applied_seq, self.batch_size)).fetchall()
+        thresholds = self.primary.execute(
+            THRESHOLD_CHANGES_SQL, (self.applied_threshold_seq, self.batch_size)).fetchall()
+        if not changes and not thresholds:
+            return 0
+        # Sequence numbers have no holes, so a jump means the primary pruned
+        # changes this replica never saw
+        if ((changes and changes[0][0] != self.applied_seq + 1)
+                or (thresholds and thresholds[0][0] != self.applied_threshold_seq + 1)):
+            print(f"Changes after {self.applied_seq} were pruned from the primary; "
+                  f"taking a new snapshot.")
+            self.snapshot()
+            self._load_state()
+            return self.apply_once()
+
+        try:
+            for seq, op, book_id, title, author, qty, changed_at in changes:
+                if op == 'delete':
+                    self.replica.execute("DELETE FROM book WHERE id = ?", (book_id,))
+                    continue
+                # Most changes are stock movements. Setting only qty keeps the
+                # replica's search index triggers, which watch title and
+                # author, from re-indexing the book.
+                cursor = self.replica.execute(
+                    "UPDATE book SET qty = ? WHERE id = ? AND title = ? AND author = ?",
+                    (qty, book_id, title, author)
+                )
+                if cursor.rowcount == 0:
+                    self.replica.execute(
+                        "INSERT INTO book (id, title, author, qty) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (id) DO UPDATE SET title = excluded.title, "
+                        "author = excluded.author, qty = excluded.qty",
+                        (book_id, title, author, qty)
+                    )
+            for seq, book_id, threshold, changed_at in thresholds:
+                if threshold is None:
+                    self.replica.execute("DELETE FROM stock_threshold WHERE book_id = ?", (book_id,))
+                else:
+                    self.replica.execute(
+                        "INSERT INTO stock_threshold (book_id, threshold) VALUES (?, ?) "
+                        "ON CONFLICT (book_id) DO UPDATE SET threshold = excluded.threshold",
+                        (book_id, threshold)
+                    )
+            if changes:
+                self.applied_seq = changes[-1][0]
+            if thresholds:
+                self.applied_threshold_seq = thresholds[-1][0]
+            self.replica.execute("UPDATE replica_state SET seq = ?, threshold_seq = ?",
+                                 (self.applied_seq, self.applied_threshold_seq))
+            self.replica.commit()
+        except sqlite3.Error:
+            self.replica.rollback()
+            self._load_state()
+            raise
+
+        now = time.time()
+        self.lag_samples.extend(now - change[6] for change in changes)
+        self.lag_samples.extend(now - change[3] for change in thresholds)
+        self.applied += len(changes) + len(thresholds)
+        return len(changes) + len(thresholds)
+
+    def catch_up(self):
+        """Apply changes until the replica has everything committed so far"""
+        total = 0
+        while True:
+            applied = self.apply_once()
+            total += applied
+            if applied < self.batch_size:
+                return total
+
+    def lag(self):
+        """Return (changes behind, seconds since the oldest unapplied change)"""
+        behind, oldest = self.primary.execute(
+            "SELECT COUNT(*), MIN(changed_at) FROM ("
+            "SELECT changed_at FROM book_changes WHERE seq > ? UNION ALL "
+            "SELECT changed_at FROM threshold_changes WHERE seq > ?)",
+            (self.applied_seq, self.applied_threshold_seq)
+        ).fetchone()
+        return behind, (time.time() - oldest) if oldest is not None else 0.0
+
+    # Tail the log on a background thread
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.apply_once() < self.batch_size:
+                    self._stop.wait(self.poll_interval)
+            except sqlite3.Error as e:
+                print(f"Replica apply failed, retrying: {e}")
+                self._stop.wait(self.poll_interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        for conn in (self.primary, self.replica):
+            if conn is not None:
+                conn.close()
+        self.primary = self.replica = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Reports open the replica read-only, tuned for long scans
+def open_replica(replica_path, profile='reporting'):
+    """Return a connected, read-only BookstoreDB on the replica"""
+    bookstore = BookstoreDB(replica_path, read_only=True, profile=profile)
+    if not bookstore.connect() or not bookstore.initialize_database():
+        raise ConnectionError(f"Could not open replica {replica_path}")
+    return bookstore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep a read replica of the bookstore current")
+    parser.add_argument('--primary', default='ebookstore.db')
+    parser.add_argument('--replica', default='replica.db')
+    parser.add_argument('--interval', type=float, default=0.1, help="seconds between polls")
+    parser.add_argument('--once', action='store_true', help="catch up once and exit")
+    args = parser.parse_args(argv)
+
+    with ReplicaApplier(args.primary, args.replica, poll_interval=args.interval) as applier:
+        applied = applier.catch_up()
+        print(f"Applied {applied} change(s); replica is at change {applier.applied_seq}.")
+        if args.once:
+            return
+        applier.start()
+        print("Tailing the change log. Press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(5)
+                behind, seconds = applier.lag()
+                print(f"At change {applier.applied_seq}: {behind} behind, lag {seconds * 1000:.0f} ms")
+        except KeyboardInterrupt:
+            print("\nStopping replica...")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# Local HTTP/JSON service in front of BookstoreDB (standard library only)
+#
+#   GET    /books                 whole catalog, streamed
+#   GET    /books?after=ID&limit=N one page of the catalog
+#   GET    /books/ID              one book
+#   POST   /books                 add a book    {"id", "title", "author", "qty"}
+#   PATCH  /books/ID              change fields {"title", "author", "qty"}
+#   DELETE /books/ID              delete a book
+#   GET    /search?q=TERM&field=title|author|any&prefix=1&limit=N
+#   GET    /search?q=TERM&fuzzy=1     typo-tolerant, closest matches first
+#   GET    /search?min_qty=A&max_qty=B
+#   GET    /low-stock             books below their threshold
+#   POST   /checkout              sell a basket atomically {"3001": 2, "3004": 1}
+#   GET    /metrics               SQL statement timings (when started with --trace)
+import json
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import sql_trace
+
+FIELDS = ('id', 'title', 'author', 'qty')
+
+
+def book_json(book):
+    return dict(zip(FIELDS, book))
+
+
+class BookstoreRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests
+    protocol_version = 'HTTP/1.1'
+    # Close idle keep-alive connections so their threads do not linger
+    timeout = 30
+    # Headers and body are separate writes; with Nagle on, the body waits
+    # for the client's delayed ACK, about 40 ms per keep-alive request
+    disable_nagle_algorithm = True
+
+    @property
+    def bookstore(self):
+        return self.server.bookstore
+
+    def db(self, operation, *args):
+        """Run a bookstore call on the server's worker pool and wait for it"""
+        return self.server.workers.submit(operation, *args).result()
+
+    def db_pages(self, page_size):
+        """Pages of the whole catalog, like BookstoreDB.iter_book_pages, with
+        each page fetched on the worker pool"""
+        last_id = None
+        while True:
+            page = self.db(self.bookstore.list_books, last_id, page_size)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            last_id = page[-1][0]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # Responses
+    def send_json(self, status, body, etag=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        if self.streaming:
+            # Part of a chunked response is already out, so a second
+            # response cannot follow; closing tells the client it failed
+            self.close_connection = True
+            return
+        self.send_json(status, {'error': message})
+
+    def send_json_stream(self, pages, etag=None):
+        """Send a JSON array page by page using chunked transfer encoding"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.streaming = True
+
+        first = True
+        self.write_chunk(b'[')
+        for page in pages:
+            rows = ",".join(json.dumps(book_json(book)) for book in page)
+            if rows:
+                self.write_chunk(((',' if not first else '') + rows).encode('utf-8'))
+                first = False
+        self.write_chunk(b']')
+        self.write_chunk(b'')
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+
+    # Conditional GETs: the ETag is the catalog version plus the request
+    def catalog_etag(self):
+        return f'"{self.db(self.bookstore.catalog_version)}-{zlib.crc32(self.path.encode()):x}"'
+
+    def not_modified(self, etag):
+        if etag in (tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return True
+        return False
+
+    # The body is read before routing, so a request rejected early never
+    # leaves it on the socket to be parsed as the next request
+    def read_body(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            raise ValueError("invalid Content-Length")
+        return self.rfile.read(length) if length else b''
+
+    def read_json(self):
+        if not self.body:
+            return {}
+        body = json.loads(self.body)
+        if not isinstance(body, dict):
+            raise ValueError("the request body must be a JSON object")
+        return body
+
+    # Routing
+    def route(self):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        book_id = None
+        if len(parts) == 2 and parts[0] == 'books':
+            book_id = int(parts[1])
+        return parts[0] if parts else '', book_id, query
+
+    def handle_request(self, method):
+        self.streaming = False
+        try:
+            self.dispatch(method)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away mid-response; there is no one to tell
+            self.close_connection = True
+
+    def dispatch(self, method):
+        try:
+            self.body = self.read_body()
+            resource, book_id, query = self.route()
+            handler = getattr(self, f"{method}_{resource.replace('-', '_')}", None)
+            if handler is None:
+                self.send_error_json(404, "Not found")
+                return
+            handler(book_id, query)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error_json(400, f"Bad request: {e}")
+        except sqlite3.Error as e:
+            self.send_error_json(500, f"Database error: {e}")
+
+    def do_GET(self):
+        self.handle_request('get')
+
+    def do_POST(self):
+        self.handle_request('post')
+
+    def do_PATCH(self):
+        self.handle_request('patch')
+
+    do_PUT = do_PATCH
+
+    def do_DELETE(self):
+        self.handle_request('delete')
+
+    # Endpoints
+    def get_books(self, book_id, query):
+        if book_id is not None:
+            book = self.db(self.bookstore.get_book, book_id)
+            if book is None:
+                self.send_error_json(404, "No book found with that ID")
+            else:
+                self.send_json(200, book_json(book))
+            return
+
+        etag = self.catalog_etag()
+        if self.not_modified(etag):
+            return
+        if 'limit' in query:
+            after = int(query['after']) if 'after' in query else None
+            page = self.db(self.bookstore.list_books, after, min(int(query['limit']), 10000))
+            self.send_json(200, [book_json(book) for book in page], etag)
+        else:
+            self.send_json_stream(self.db_pages(1000), etag)
+
+    def post_books(self, book_id, query):
+        book = self.read_json()
+        title, author = str(book['title']).strip(), str(book['author']).strip()
+        if not title or not author:
+            raise ValueError("title and author cannot be empty")
+        if not self.db(self.bookstore.insert_book, int(book['id']), title, author, int(book['qty'])):
+            self.send_error_json(409, "A book with this ID already exists")
+            return
+        self.send_json(201, book_json(self.db(self.bookstore.get_book, int(book['id']))))
+
+    def patch_books(self, book_id, query):
+        if book_id is None:
+            raise ValueError("a book ID is required")
+        changes = self.read_json()
+        qty = int(changes['qty']) if changes.get('qty') is not None else None
+        book = self.db(self.bookstore.edit_book, book_id, changes.get('title') or None,
+                       changes.get('author') or None, qty)
+        if book is None:
+            self.send_error_json(404, "No book found with that ID")
+        else:
+            self.send_json(200, book_json(book))
+
+    def delete_books(self, book_id, query):
+        if book_id is None:
+            raise ValueError("a book ID is required")
+        if not self.db(self.bookstore.remove_book, book_id):
+            self.send_error_json(404, "No book found with that ID")
+            return
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def get_search(self, book_id, query):
+        etag = self.catalog_etag()
+        if self.not_modified(etag):
+            return
+        if 'q' in query:
+            columns = {'title': ('title',), 'author': ('author',)}.get(query.get('field'),
+                                                                     ('title', 'author'))
+            limit = int(query['limit']) if 'limit' in query else None
+            if query.get('fuzzy') in ('1', 'true', 'yes'):
+                results = self.db(self.bookstore.fuzzy_find_books, query['q'], columns, limit or 10)
+            else:
+                results = self.db(self.bookstore.find_books, query['q'], columns,
+                                  query.get('prefix') in ('1', 'true', 'yes'), limit)
+        else:
+            results = self.db(self.bookstore.search_by_qty, int(query['min_qty']),
+                              int(query['max_qty']))
+        self.send_json_stream([results], etag)
+
+    def post_checkout(self, book_id, query):
+        basket = {int(key): value for key, value in self.read_json().items()}
+        result = self.db(self.bookstore.checkout, basket)
+        failed = [{'id': line[0], 'qty': line[1], 'reason': line[2]} for line in result['failed']]
+        self.send_json(200 if result['ok'] else 409, {'ok': result['ok'], 'failed': failed})
+
+    def get_low_stock(self, book_id, query):
+        etag = self.catalog_etag()
+        if self.not_modified(etag):
+            return
+        books = self.db(self.bookstore.low_stock_books)
+        self.send_json(200, {'count': len(books), 'books': [book_json(book) for book in books]}, etag)
+
+    def get_metrics(self, book_id, query):
+        if not sql_trace.enabled():
+            self.send_error_json(404, "SQL tracing is off; start the server with --trace")
+            return
+        if query.get('format') == 'json':
+            self.send_json(200, sql_trace.TRACER.to_dict())
+            return
+        data = sql_trace.TRACER.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class BookstoreHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server with a thread per connection and a fixed pool of workers
+    for the database calls.
+
+    Keep-alive connections spend most of their life idle, so each gets its
+    own cheap thread; only the database work is limited to the workers
+    (and so to the connection pool).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, bookstore, workers=8, verbose=False):
+        super().__init__(address, BookstoreRequestHandler)
+        self.bookstore = bookstore
+        self.verbose = verbose
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+
+    def server_close(self):
+        super().server_close()
+        self.workers.shutdown(wait=True)
+
+
+def serve(bookstore, host='127.0.0.1', port=8080, workers=8, verbose=False):
+    """Serve the bookstore until interrupted with Ctrl+C"""
+    server = BookstoreHTTPServer((host, port), bookstore, workers, verbose)
+    print(f"Serving the bookstore on http://{host}:{server.server_port}/ "
+          f"with {workers} worker(s). Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping server...")
+    finally:
+        server.server_close()
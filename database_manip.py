@@ -1,6 +1,8 @@
 import sqlite3
 import os
 
+import sql_trace
+
 # Get valid integer input from user
 # This function repeatedly prompts the user until a valid integer is entered.
 # It can also enforce optional minimum and maximum value constraints.
@@ -59,7 +61,8 @@ def get_valid_string_input(prompt, min_length=1):
 def db_connect(db_file):
     """Initialize database connection"""
     try:
-        conn = sqlite3.connect(db_file)
+        # Traced when BOOKSTORE_TRACE=1 is set, see sql_trace.py
+        conn = sql_trace.connect(db_file)
         print(f"DB connection established: {db_file}")
         return conn
     except sqlite3.Error as e:
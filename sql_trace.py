@@ -0,0 +1,223 @@
+# Opt-in per-statement SQL instrumentation for sqlite3 connections
+#
+# Turn it on with the BOOKSTORE_TRACE=1 environment variable (or enable()).
+# Set BOOKSTORE_TRACE_FILE to a .json or .prom path to write the statistics
+# when the program exits. When tracing is off, connect() returns a plain
+# sqlite3 connection, so there is no overhead at all.
+import atexit
+import functools
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# Group statements that only differ in literals or spacing
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    """Return sql with literals replaced by ? and whitespace collapsed"""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", sql)
+    return " ".join(sql.split())
+
+
+class SQLTracer:
+    """Counts, time, rows and a latency histogram per normalized statement"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, sql, seconds, rows):
+        key = normalize(sql)
+        with self._lock:
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = {'count': 0, 'seconds': 0.0, 'rows': 0,
+                                          'buckets': [0] * (len(BUCKETS) + 1)}
+            stat['count'] += 1
+            stat['seconds'] += seconds
+            stat['rows'] += rows
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                index = len(BUCKETS)
+            stat['buckets'][index] += 1
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def to_dict(self):
+        """Return the statistics, slowest statements (by total time) first"""
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda item: -item[1]['seconds'])
+            return {
+                'buckets': list(BUCKETS),
+                'statements': [
+                    dict(sql=sql, count=stat['count'], seconds=stat['seconds'], rows=stat['rows'],
+                         mean_ms=stat['seconds'] / stat['count'] * 1000,
+                         histogram=list(stat['buckets']))
+                    for sql, stat in items
+                ],
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix='bookstore_sql'):
+        """Return the statistics in the Prometheus text exposition format"""
+        def label(sql):
+            return sql.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        statements = self.to_dict()['statements']
+        lines = [
+            f"# HELP {prefix}_statements_total Statements executed.",
+            f"# TYPE {prefix}_statements_total counter",
+        ]
+        lines += [f'{prefix}_statements_total{{sql="{label(s["sql"])}"}} {s["count"]}' for s in statements]
+        lines += [
+            f"# HELP {prefix}_rows_total Rows returned.",
+            f"# TYPE {prefix}_rows_total counter",
+        ]
+        lines += [f'{prefix}_rows_total{{sql="{label(s["sql"])}"}} {s["rows"]}' for s in statements]
+        lines += [
+            f"# HELP {prefix}_latency_seconds Time spent executing and fetching.",
+            f"# TYPE {prefix}_latency_seconds histogram",
+        ]
+        for s in statements:
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), s['histogram']):
+                cumulative += count
+                lines.append(f'{prefix}_latency_seconds_bucket{{sql="{label(s["sql"])}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_latency_seconds_sum{{sql="{label(s["sql"])}"}} {s["seconds"]}')
+            lines.append(f'{prefix}_latency_seconds_count{{sql="{label(s["sql"])}"}} {s["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write JSON, or Prometheus text if path ends in .prom or .txt"""
+        text = self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json()
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+TRACER = SQLTracer()
+_enabled = os.environ.get('BOOKSTORE_TRACE', '').lower() in ('1', 'true', 'yes')
+_exit_path = None
+
+
+class TracingCursor(sqlite3.Cursor):
+    """Cursor that times each statement from execute() until its rows are read"""
+
+    _pending = None
+
+    def _finish(self):
+        if self._pending is not None:
+            sql, seconds, rows = self._pending
+            self._pending = None
+            TRACER.record(sql, seconds, rows)
+
+    def _timed(self, method, sql, *args):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            self._pending = (sql, time.perf_counter() - start, 0)
+            # Statements that return no rows are complete straight away
+            if self.description is None:
+                self._finish()
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def _fetched(self, start, rows, done):
+        if self._pending is not None:
+            sql, seconds, count = self._pending
+            self._pending = (sql, seconds + time.perf_counter() - start, count + rows)
+            if done:
+                self._finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._fetched(start, len(rows), len(rows) < (size or self.arraysize))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+        self._fetched(start, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+
+class TracingConnection(sqlite3.Connection):
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    # Connection.execute() would skip our cursor, so route it through one
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def enable(exit_path=None):
+    """Trace connections opened from now on; optionally dump stats at exit"""
+    global _enabled, _exit_path
+    _enabled = True
+    if exit_path:
+        _exit_path = exit_path
+
+
+def enabled():
+    return _enabled
+
+
+def connect(database, **kwargs):
+    """sqlite3.connect() that returns a tracing connection when tracing is on"""
+    if _enabled:
+        kwargs.setdefault('factory', TracingConnection)
+    return sqlite3.connect(database, **kwargs)
+
+
+@atexit.register
+def _write_at_exit():
+    path = _exit_path or os.environ.get('BOOKSTORE_TRACE_FILE')
+    if _enabled and path and TRACER.stats:
+        TRACER.write(path)
+        # stderr, so it never ends up in data a command wrote to stdout
+        print(f"SQL trace written to {path}", file=sys.stderr)
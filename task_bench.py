@@ -0,0 +1,285 @@
+# Benchmarks for the task manager's storage
+# Run with: python task_bench.py <command> --help
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from bookstore_bench import time_operation
+from task_codec import (Task, deadline_status, encode, format_legacy, parse_date,
+                        parse_legacy, read_records)
+from task_stats import TaskStats
+from task_store import TaskStore, overdue_cutoff
+
+TITLES = ["Stocktake", "Invoice run", "Shelf audit", "Supplier call", "Rota",
+          "Window display", "Returns", "Training", "Order books", "Clean store"]
+
+
+# Make up a task list spread over many staff
+def synthetic_tasks(tasks, users, seed=42):
+    """Yield Task tuples for a made-up team"""
+    rng = random.Random(seed)
+    start = datetime.date(2024, 1, 1)
+    # Dates are formatted up front, the way a real file repeats the same few hundred
+    days = [(start + datetime.timedelta(days=day)).strftime("%d %b %Y") for day in range(800)]
+    for number in range(tasks):
+        assigned = rng.randint(0, 700)
+        due = assigned + rng.randint(1, 90)
+        yield Task(f"staff{rng.randrange(users)}", rng.choice(TITLES),
+                   f"Task {number}, see the shared drive",
+                   days[assigned], days[due], rng.choice(("Yes", "No")))
+
+
+# Write a task file in the record format, or in the old one with legacy=True
+def make_task_file(directory, tasks, users, legacy=False, name='tasks.txt'):
+    path = os.path.join(directory, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        if legacy:
+            f.write("\n".join(format_legacy(task) for task in synthetic_tasks(tasks, users)))
+        else:
+            f.writelines(encode(task) for task in synthetic_tasks(tasks, users))
+    return path
+
+
+# "View my tasks" without an index: decode every line, keep the caller's
+def linear_tasks_for(path, user):
+    return [task for task in read_records(path) if task.user == user]
+
+
+# "View my tasks" with and without the offset index
+def view_mine(tasks=500000, users=2000, queries=200):
+    """Time vm for random users on a large task list"""
+    rng = random.Random(7)
+    names = [f"staff{rng.randrange(users)}" for _ in range(queries)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_task_file(directory, tasks, users)
+        size = os.path.getsize(path)
+
+        # The first open builds the index, later opens load it
+        start = time.perf_counter()
+        store = TaskStore(path).open()
+        store.close()
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        store = TaskStore(path).open()
+        load = time.perf_counter() - start
+
+        results = {
+            'indexed': time_operation(lambda i: list(store.tasks_for(names[i])), queries),
+            'linear scan': time_operation(lambda i: linear_tasks_for(path, names[i]),
+                                          min(queries, 10)),
+        }
+        found = sum(len(list(store.tasks_for(name))) for name in names) / queries
+
+    print(f"\nView my tasks: {tasks} tasks ({size / 1e6:.0f} MB) across {users} staff, "
+          f"{found:.0f} tasks per user on average")
+    print(f"index built in {build * 1000:.0f} ms on first open, loaded in {load * 1000:.0f} ms after")
+    print(f"{'':14}{'p50 ms':>10}{'p95 ms':>10}{'runs':>8}")
+    for name, result in results.items():
+        print(f"{name:14}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['n']:>8}")
+    return results
+
+
+# Deadline range queries with and without the due-date index
+def due_queries(tasks=500000, users=2000, queries=100):
+    """Time 'due in the next week' and 'overdue' on a large task list"""
+    rng = random.Random(11)
+    first = datetime.datetime(2024, 1, 1)
+    days = [first + datetime.timedelta(days=rng.randint(0, 790), hours=9) for _ in range(queries)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_task_file(directory, tasks, users)
+        store = TaskStore(path).open()
+
+        def scan_week(now):
+            today = now.date()
+            return [task for task in read_records(path) if task.completed != 'Yes'
+                    and 0 <= (parse_date(task.due).date() - today).days <= 7]
+
+        results = {
+            'week, indexed': time_operation(lambda i: list(store.due_within(7, days[i])), queries),
+            'week, scan': time_operation(lambda i: scan_week(days[i]), min(queries, 5)),
+            'overdue, indexed': time_operation(lambda i: list(store.overdue(days[i])), queries),
+        }
+        week = sum(len(list(store.due_within(7, day))) for day in days) / queries
+        overdue = sum(len(list(store.overdue(day))) for day in days) / queries
+
+    print(f"\nDeadline queries on {tasks} tasks: {week:.0f} due in the week and "
+          f"{overdue:.0f} overdue on average")
+    print(f"{'':18}{'p50 ms':>10}{'p95 ms':>10}{'runs':>8}")
+    for name, result in results.items():
+        print(f"{name:18}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['n']:>8}")
+    return results
+
+
+# The admin's statistics: cached counts against a pass over the file
+def stats_latency(tasks=500000, users=2000, queries=1000):
+    """Time ds on a large task list, and the work that keeps it current"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_task_file(directory, tasks, users)
+        store = TaskStore(path).open()
+        now = datetime.datetime.now()
+        extra = list(synthetic_tasks(queries, users, seed=9))
+
+        def one_pass(i):
+            stats = TaskStats(overdue_cutoff(now).toordinal())
+            for task in read_records(path):
+                stats.add(task)
+
+        # Every stored count falls a day behind, so each call reads the
+        # tasks whose deadline passed on that day
+        def next_day(i):
+            store.statistics(now + datetime.timedelta(days=i + 1))
+
+        results = {
+            'ds, cached': time_operation(lambda i: store.statistics(now), queries),
+            'add then ds': time_operation(
+                lambda i: (store.add(extra[i]), store.statistics(now)), queries),
+            'ds, next day': time_operation(next_day, min(queries, 30)),
+            'full pass': time_operation(one_pass, 3),
+        }
+        store.close()
+
+    print(f"\nStatistics on {tasks} tasks across {users} staff")
+    print(f"{'':14}{'p50 ms':>10}{'p95 ms':>10}{'runs':>8}")
+    for name, result in results.items():
+        print(f"{name:14}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['n']:>8}")
+    return results
+
+
+# Edit latency as the task file grows, and what compaction costs
+def edit_latency(sizes=(50000, 500000, 2000000), users=2000, edits=2000):
+    """Time complete, reassign and re-date on task files of several sizes"""
+    results = {}
+    for tasks in sizes:
+        rng = random.Random(13)
+        with tempfile.TemporaryDirectory() as directory:
+            path = make_task_file(directory, tasks, users)
+            # Compaction is timed on its own below
+            store = TaskStore(path, compact_ratio=1.0).open()
+            task_ids = [task_id for offsets in store.by_user.values() for task_id in offsets]
+            picks = [rng.choice(task_ids) for _ in range(edits)]
+            days = [f"{rng.randint(1, 28):02d} Mar 2025" for _ in range(edits)]
+
+            def edit(i):
+                if i % 3 == 0:
+                    store.complete(picks[i])
+                elif i % 3 == 1:
+                    store.reassign(picks[i], f"staff{i % users}")
+                else:
+                    store.set_deadline(picks[i], days[i])
+
+            result = time_operation(edit, edits)
+            start = time.perf_counter()
+            store.compact()
+            result['compact_s'] = time.perf_counter() - start
+            store.close()
+            results[tasks] = result
+
+    print(f"\nEdits appended to the update log, {edits} per file size")
+    print(f"{'tasks':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'compact s':>12}")
+    for tasks, result in results.items():
+        print(f"{tasks:>10}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}"
+              f"{result['p99_ms']:>10.3f}{result['compact_s']:>12.2f}")
+    return results
+
+
+# How fast whole files are read and listed, old format against new
+def parse_throughput(tasks=2000000, users=2000):
+    """Time reading every task, and working out every deadline status"""
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_path = make_task_file(directory, tasks, users, legacy=True, name='legacy.txt')
+        path = make_task_file(directory, tasks, users)
+
+        def legacy_read():
+            with open(legacy_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        parse_legacy(line)
+
+        # What va used to do per line: split, then strptime and now() again
+        def legacy_listing():
+            with open(legacy_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        task = parse_legacy(line)
+                        try:
+                            due_date = datetime.datetime.strptime(task.due, '%d %b %Y')
+                            days_remaining = (due_date - datetime.datetime.now()).days
+                            status = f"{days_remaining} days remaining"
+                        except ValueError:
+                            status = "Invalid date format"
+
+        def read():
+            for task in read_records(path):
+                pass
+
+        def listing():
+            now = datetime.datetime.now()
+            for task in read_records(path):
+                deadline_status(task.due, now)
+
+        def run(operation, path):
+            parse_date.cache_clear()
+            start = time.perf_counter()
+            operation()
+            return time.perf_counter() - start, os.path.getsize(path)
+
+        results = {
+            'legacy split': run(legacy_read, legacy_path),
+            'record decode': run(read, path),
+            'legacy listing': run(legacy_listing, legacy_path),
+            'record listing': run(listing, path),
+        }
+
+    print(f"\nReading {tasks} tasks (listing = decode plus deadline status)")
+    print(f"{'':16}{'seconds':>10}{'tasks/s':>12}{'MB/s':>8}")
+    for name, (seconds, size) in results.items():
+        print(f"{name:16}{seconds:>10.2f}{tasks / seconds:>12,.0f}{size / seconds / 1e6:>8.0f}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Task manager storage benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    vm_parser = commands.add_parser('vm', help="view one user's tasks on a large task list")
+    vm_parser.add_argument('--tasks', type=int, default=500000)
+    vm_parser.add_argument('--users', type=int, default=2000)
+    vm_parser.add_argument('--queries', type=int, default=200)
+
+    parse_parser = commands.add_parser('parse', help="read and list whole task files")
+    parse_parser.add_argument('--tasks', type=int, default=2000000)
+    parse_parser.add_argument('--users', type=int, default=2000)
+
+    due_parser = commands.add_parser('due', help="deadline range queries on a large task list")
+    due_parser.add_argument('--tasks', type=int, default=500000)
+    due_parser.add_argument('--users', type=int, default=2000)
+    due_parser.add_argument('--queries', type=int, default=100)
+
+    stats_parser = commands.add_parser('stats', help="ds on a large task list")
+    stats_parser.add_argument('--tasks', type=int, default=500000)
+    stats_parser.add_argument('--users', type=int, default=2000)
+    stats_parser.add_argument('--queries', type=int, default=1000)
+
+    edit_parser = commands.add_parser('edit', help="edit latency as the task file grows")
+    edit_parser.add_argument('--sizes', type=int, nargs='+', default=[50000, 500000, 2000000])
+    edit_parser.add_argument('--users', type=int, default=2000)
+    edit_parser.add_argument('--edits', type=int, default=2000)
+
+    args = parser.parse_args(argv)
+    if args.command == 'vm':
+        view_mine(args.tasks, args.users, args.queries)
+    elif args.command == 'due':
+        due_queries(args.tasks, args.users, args.queries)
+    elif args.command == 'stats':
+        stats_latency(args.tasks, args.users, args.queries)
+    elif args.command == 'edit':
+        edit_latency(args.sizes, args.users, args.edits)
+    elif args.command == 'parse':
+        parse_throughput(args.tasks, args.users)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Reading and writing task records
+#
+# Tasks are stored one JSON array per line:
+#   ["admin", "Title", "Description, with commas", "10 Oct 2019", "25 Oct 2019", "No"]
+# JSON escapes quotes, commas and newlines, so any text round-trips and every
+# record stays on one line for the offset index in task_store.py.
+#
+# The old format ("user, title, description, assigned, due, No") is still
+# read for imports, and migrate_legacy() converts an old tasks.txt in place.
+import datetime
+import json
+import os
+import shutil
+from collections import namedtuple
+from functools import lru_cache
+
+Task = namedtuple('Task', 'user title description assigned due completed')
+
+DATE_FORMAT = '%d %b %Y'
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(', ', ': ')).encode
+# The decoder's C scanner, called directly: json.loads adds a regex pass and
+# Task(*fields) a Python-level __new__, which together tripled the cost per line
+_scan = json.JSONDecoder().scan_once
+_new_task = tuple.__new__
+
+
+# Records
+def encode(task):
+    """Return the stored line for a task, newline included"""
+    return _encode(list(task)) + "\n"
+
+
+def decode(line):
+    """Turn a stored line back into a Task"""
+    try:
+        fields, _ = _scan(line, 0)
+    except StopIteration:
+        fields = None
+    if type(fields) is not list or len(fields) != len(Task._fields):
+        raise ValueError(f"Not a task record: {line!r}")
+    return _new_task(Task, fields)
+
+
+def read_records(path):
+    """Yield the tasks in a file one at a time, decoding each only when asked for"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield decode(line)
+
+
+# The comma separated format task_manager.py used to write
+def parse_legacy(line):
+    """Parse 'user, title, description, assigned, due, completed'"""
+    parts = line.strip().split(', ')
+    if len(parts) < 6:
+        raise ValueError(f"Not a task line: {line!r}")
+    # Only the description is free text, so any extra ', ' belongs to it
+    return Task(parts[0], parts[1], ', '.join(parts[2:-3]), *parts[-3:])
+
+
+def format_legacy(task):
+    return ', '.join(task)
+
+
+def is_legacy(path):
+    """True if the file holds tasks in the old comma separated format"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                return not line.lstrip().startswith('[')
+    return False
+
+
+def migrate_legacy(path, backup_suffix='.bak'):
+    """Convert an old format file in place; returns the number of tasks converted"""
+    if not os.path.exists(path) or not is_legacy(path):
+        return 0
+    # Write the new file beside the old one and swap it in, so a crash
+    # leaves either the old file or the new one, never half of each
+    temp_path = path + '.tmp'
+    converted = 0
+    with open(path, encoding='utf-8') as old, open(temp_path, 'w', encoding='utf-8') as new:
+        for line in old:
+            if line.strip():
+                new.write(encode(parse_legacy(line)))
+                converted += 1
+        new.flush()
+        os.fsync(new.fileno())
+    shutil.copy2(path, path + backup_suffix)
+    os.replace(temp_path, path)
+    return converted
+
+
+# Deadlines
+@lru_cache(maxsize=4096)
+def parse_date(text):
+    """Return the datetime for a 'dd Mon yyyy' date, or None if it is not one"""
+    # Many tasks share a deadline, so each distinct date is parsed only once
+    try:
+        return datetime.datetime.strptime(text, DATE_FORMAT)
+    except ValueError:
+        return None
+
+
+def deadline_status(due, now):
+    """Describe how far a deadline is from now, e.g. '3 days remaining'"""
+    due_date = parse_date(due)
+    if due_date is None:
+        return "Invalid date format"
+    days_remaining = (due_date - now).days
+    if days_remaining < 0:
+        return f"OVERDUE by {abs(days_remaining)} days"
+    return f"{days_remaining} days remaining"
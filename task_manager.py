@@ -2,6 +2,11 @@
 import time
 import os
 import datetime
+import atexit
+
+from task_codec import deadline_status
+from task_stats import percent
+from task_store import Task, TaskStore
 
 # Check if user.txt exists, create it if not
 if not os.path.exists('user.txt'):
@@ -13,6 +18,13 @@ if not os.path.exists('tasks.txt'):
     with open('tasks.txt', 'w') as f:
         f.write("")  # Create empty file
 
+# Tasks are read through an index, so "view my tasks" only reads your own
+store = TaskStore('tasks.txt').open()
+atexit.register(store.close)
+if store.migrated:
+    print(f"Converted {store.migrated} task(s) in tasks.txt to the new format "
+          f"(the old file is kept as tasks.txt.bak)")
+
 # ====Login Section====
 # This function is for the log in process
 # Ask for user input
@@ -39,6 +51,35 @@ while not user_logged:
     else:
         print("Incorrect login details, please try again")
 
+# ====Display Section====
+# Print one task; now is taken once per listing so every line agrees
+def display_task(task, now, show_user=True):
+    # Calculate days remaining for due date
+    status = deadline_status(task.due, now)
+    assigned_to = f"\nAssigned to:    {task.user}" if show_user else ""
+
+    # Display all task information in proper format
+    print(f"""
+Task:           {task.title}{assigned_to}
+Date assigned:  {task.assigned}
+Due date:       {task.due} ({status})
+Completed:      {task.completed}
+Description:    {task.description}
+-------------------------""")
+
+
+# Ask for a date until one in the right format is given
+def ask_date(prompt):
+    while True:
+        answer = input(prompt)
+        try:
+            # Validate date format
+            datetime.datetime.strptime(answer, '%d %b %Y')
+            return answer
+        except ValueError:
+            print("Invalid date format. Please use format like '10 Sep 2003'")
+
+
 # ====Main Menu Section====
 # This function is for the main menu
 while True:
@@ -50,7 +91,11 @@ r - register a user
 a - add a task
 va - view all tasks
 vm - view my tasks
+vd - view tasks due between two dates
+vo - view overdue tasks
+et - edit one of my tasks
 ds - display statistics
+gr - generate reports
 e - exit                                                                                        
 :   ''').lower()
     else:
@@ -59,6 +104,9 @@ e - exit
 a - add a task
 va - view all tasks
 vm - view my tasks
+vd - view tasks due between two dates
+vo - view overdue tasks
+et - edit one of my tasks
 e - exit
 :   ''').lower()
 
@@ -99,110 +147,117 @@ e - exit
         task_description = input("Enter task description: ")
         
         # Date validation
-        while True:
-            task_deadline = input("Enter task due date (e.g. 10 Sep 2003): ")
-            try:
-                # Validate date format
-                datetime.datetime.strptime(task_deadline, '%d %b %Y')
-                break
-            except ValueError:
-                print("Invalid date format. Please use format like '10 Sep 2003'")
+        task_deadline = ask_date("Enter task due date (e.g. 10 Sep 2003): ")
         
         # Get current date in correct format
         date_today = time.strftime("%d %b %Y")
         
-        # Write the task to the file with proper formatting
-        task_data = f"{registered_user}, {task_type}, {task_description}, {date_today}, {task_deadline}, No"
-        
-        # Check if file is empty to determine if we need a newline
-        if os.path.getsize('tasks.txt') > 0:
-            task_data = "\n" + task_data
-            
-        with open('tasks.txt', 'a') as f:
-            f.write(task_data)
+        # Write the task to the file and index it
+        store.add(Task(registered_user, task_type, task_description, date_today, task_deadline, "No"))
 
         print(f"Task successfully added for {registered_user}.")
 
     # If user chooses va 
     elif menu == 'va':
-        try:
-            with open('tasks.txt', 'r') as f:
-                print("\nAll tasks:")
-                for line in f:
-                    if line.strip():
-                        sectors = line.strip().split(', ')
-                        # Calculate days remaining for due date
-                        try:
-                            due_date = datetime.datetime.strptime(sectors[4], '%d %b %Y')
-                            today = datetime.datetime.now()
-                            days_remaining = (due_date - today).days
-                            if days_remaining < 0:
-                                status = f"OVERDUE by {abs(days_remaining)} days"
-                            else:
-                                status = f"{days_remaining} days remaining"
-                        except:
-                            status = "Invalid date format"
-                        
-                        # Display all task information in proper format
-                        print(f"""
-Task:           {sectors[1]}
-Assigned to:    {sectors[0]}
-Date assigned:  {sectors[3]}
-Due date:       {sectors[4]} ({status})
-Completed:      {sectors[5]}
-Description:    {sectors[2]}
--------------------------""")
-        except FileNotFoundError:
-            print("No tasks found. Please add tasks first.")
+        print("\nAll tasks:")
+        now = datetime.datetime.now()
+        for task in store.tasks():
+            display_task(task, now)
 
     # If user chooses vm
     elif menu == 'vm':
+        print(f"\nMy tasks for {present}:")
+        now = datetime.datetime.now()
+        # The index knows where this user's tasks are, so only they are read
+        for task in store.tasks_for(present):
+            display_task(task, now, show_user=False)
+
+    # If user chooses vd
+    elif menu == 'vd':
+        start = ask_date("Show tasks due from (e.g. 10 Sep 2003): ")
+        end = ask_date("Up to and including (e.g. 17 Sep 2003): ")
+        print(f"\nTasks due from {start} to {end}:")
+        now = datetime.datetime.now()
+        # The deadline index goes straight to the first task in the range
+        found = 0
+        for task in store.due_between(start, end):
+            display_task(task, now)
+            found += 1
+        print(f"{found} task(s) due in that period.")
+
+    # If user chooses vo
+    elif menu == 'vo':
+        print("\nOverdue tasks:")
+        now = datetime.datetime.now()
+        found = 0
+        for task in store.overdue(now):
+            display_task(task, now)
+            found += 1
+        print(f"{found} task(s) overdue.")
+
+    # If user chooses et
+    elif menu == 'et':
+        task_ids = store.task_ids_for(present)
+        # Another session compacting the file changes every task id
+        generation = store.generation
+        if not task_ids:
+            print("You have no tasks to edit.")
+            continue
+        print(f"\nMy tasks for {present}:")
+        for number, task in enumerate(store.tasks_at(task_ids), 1):
+            print(f"{number} - {task.title} (due {task.due}, completed: {task.completed})")
+
+        choice = input("Enter the number of the task to edit, or -1 to return to the menu: ")
+        if choice == '-1':
+            continue
+        if not choice.isdigit() or not 1 <= int(choice) <= len(task_ids):
+            print("There is no task with that number.")
+            continue
+        task_id = task_ids[int(choice) - 1]
+        action = input('''c - mark as complete
+r - reassign to another user
+d - change the due date
+:   ''').lower()
+        # Every edit is one small record appended to the update log
         try:
-            with open('tasks.txt', 'r') as f:
-                print(f"\nMy tasks for {present}:")
-                for line in f:
-                    if line.strip():
-                        sectors = line.strip().split(', ')
-                        if sectors[0] == present:
-                            # Calculate days remaining for due date
-                            try:
-                                due_date = datetime.datetime.strptime(sectors[4], '%d %b %Y')
-                                today = datetime.datetime.now()
-                                days_remaining = (due_date - today).days
-                                if days_remaining < 0:
-                                    status = f"OVERDUE by {abs(days_remaining)} days"
-                                else:
-                                    status = f"{days_remaining} days remaining"
-                            except:
-                                status = "Invalid date format"
-                            
-                            # Display all task information in proper format
-                            print(f"""
-Task:           {sectors[1]}
-Date assigned:  {sectors[3]}
-Due date:       {sectors[4]} ({status})
-Completed:      {sectors[5]}
-Description:    {sectors[2]}
--------------------------""")
-        except FileNotFoundError:
-            print("No tasks found. Please add tasks first.")
+            task = store.get(task_id, generation)
+            if task.completed == 'Yes':
+                print("This task is already complete and can no longer be edited.")
+            elif action == 'c':
+                store.complete(task_id, generation)
+                print(f"Task '{task.title}' marked as complete.")
+            elif action == 'r':
+                new_owner = input("Enter the username of the user to assign the task to: ")
+                if new_owner not in user:
+                    print("User not found.")
+                    continue
+                store.reassign(task_id, new_owner, generation)
+                print(f"Task '{task.title}' reassigned to {new_owner}.")
+            elif action == 'd':
+                new_deadline = ask_date("Enter the new due date (e.g. 10 Sep 2003): ")
+                store.set_deadline(task_id, new_deadline, generation)
+                print(f"Task '{task.title}' is now due on {new_deadline}.")
+            else:
+                print("Invalid option. Please try again.")
+        except ValueError as e:
+            # The ids listed above no longer name the same tasks
+            print(e)
 
     # If admin chooses ds (display statistics)
     elif menu == 'ds' and present == 'admin':
-        try:
-            # Count number of users
-            with open('user.txt', 'r') as f:
-                user_count = sum(1 for line in f)
-            
-            # Count number of tasks
-            with open('tasks.txt', 'r') as f:
-                task_count = sum(1 for line in f if line.strip())
-                
-            print(f"\nStatistics:")
-            print(f"Total number of users: {user_count}")
-            print(f"Total number of tasks: {task_count}")
-        except FileNotFoundError:
-            print("Error accessing data files.")
+        # Users are already loaded and the task counts are kept up to date
+        # as tasks are added, so nothing needs to be read here
+        stats = store.statistics()
+        print(f"\nStatistics:")
+        print(f"Total number of users: {len(user)}")
+        print(f"Total number of tasks: {stats.total}")
+        print(f"Completed tasks:       {stats.completed} ({percent(stats.completed, stats.total):.1f}%)")
+        print(f"Overdue tasks:         {stats.overdue} ({percent(stats.overdue, stats.total):.1f}%)")
+
+    # If admin chooses gr (generate reports)
+    elif menu == 'gr' and present == 'admin':
+        store.statistics().write_reports(user)
+        print("Reports written to task_overview.txt and user_overview.txt.")
 
     # If user chooses e
     elif menu == 'e':
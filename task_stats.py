@@ -0,0 +1,150 @@
+# Task statistics, kept current as tasks are added and edited
+#
+# TaskStats is filled in the same pass that builds the task index, then
+# updated one task at a time (an edit is a remove and an add), so asking for
+# the numbers costs nothing.
+# Overdue counts depend on the day; see TaskStore.statistics() for how they
+# are brought forward when the date changes.
+from functools import lru_cache
+
+from task_codec import parse_date
+
+
+@lru_cache(maxsize=4096)
+def due_month(due):
+    """'2024-03' for a task due in March 2024, or None for a bad date"""
+    due_date = parse_date(due)
+    return None if due_date is None else f"{due_date.year}-{due_date.month:02d}"
+
+
+# Share of total as a percentage, 0 when there is nothing to share
+def percent(part, total):
+    return 100.0 * part / total if total else 0.0
+
+
+class TaskStats:
+    """Task counts overall, per user and per due month"""
+
+    def __init__(self, day):
+        # Ordinal of the last day whose deadlines count as passed
+        self.day = day
+        self.total = 0
+        self.completed = 0
+        self.overdue = 0
+        self.invalid_dates = 0
+        # user -> [tasks, completed, overdue]
+        self.users = {}
+        self.months = {}
+
+    # Count one more task
+    def add(self, task):
+        counts = self.users.get(task.user)
+        if counts is None:
+            counts = self.users[task.user] = [0, 0, 0]
+        counts[0] += 1
+        self.total += 1
+
+        month = due_month(task.due)
+        if month is None:
+            self.invalid_dates += 1
+        else:
+            self.months[month] = self.months.get(month, 0) + 1
+
+        if task.completed == 'Yes':
+            counts[1] += 1
+            self.completed += 1
+        elif month is not None and parse_date(task.due).toordinal() <= self.day:
+            counts[2] += 1
+            self.overdue += 1
+
+    # Stop counting a task, before it changes or goes away
+    def remove(self, task):
+        counts = self.users[task.user]
+        counts[0] -= 1
+        self.total -= 1
+
+        month = due_month(task.due)
+        if month is None:
+            self.invalid_dates -= 1
+        else:
+            self.months[month] -= 1
+            if not self.months[month]:
+                del self.months[month]
+
+        if task.completed == 'Yes':
+            counts[1] -= 1
+            self.completed -= 1
+        elif month is not None and parse_date(task.due).toordinal() <= self.day:
+            counts[2] -= 1
+            self.overdue -= 1
+
+    def mark_overdue(self, tasks):
+        """Count tasks whose deadline passed since self.day"""
+        for task in tasks:
+            self.users[task.user][2] += 1
+            self.overdue += 1
+
+    # Saved alongside the task index
+    def to_dict(self):
+        return {'day': self.day, 'total': self.total, 'completed': self.completed,
+                'overdue': self.overdue, 'invalid_dates': self.invalid_dates,
+                'users': self.users, 'months': self.months}
+
+    @classmethod
+    def from_dict(cls, saved):
+        stats = cls(saved['day'])
+        stats.total = saved['total']
+        stats.completed = saved['completed']
+        stats.overdue = saved['overdue']
+        stats.invalid_dates = saved['invalid_dates']
+        stats.users = saved['users']
+        stats.months = saved['months']
+        return stats
+
+    # Reports
+    def task_overview(self):
+        """Text of the task overview report"""
+        incomplete = self.total - self.completed
+        lines = [
+            "Task overview",
+            "=============",
+            f"Total tasks:              {self.total}",
+            f"Completed tasks:          {self.completed}",
+            f"Uncompleted tasks:        {incomplete}",
+            f"Uncompleted and overdue:  {self.overdue}",
+            f"Incomplete:               {percent(incomplete, self.total):.1f}%",
+            f"Overdue:                  {percent(self.overdue, self.total):.1f}%",
+        ]
+        if self.invalid_dates:
+            lines.append(f"Without a valid due date: {self.invalid_dates}")
+        lines += ["", "Tasks by due month", "------------------"]
+        lines += [f"{month}  {count:>8}" for month, count in sorted(self.months.items())]
+        return "\n".join(lines) + "\n"
+
+    def user_overview(self, users=()):
+        """Text of the user overview report; users lists people with no tasks too"""
+        names = sorted(set(users) | set(self.users))
+        lines = [
+            "User overview",
+            "=============",
+            f"Total users: {len(names)}",
+            f"Total tasks: {self.total}",
+            "",
+            f"{'User':<20} {'Tasks':>7} {'Share':>7} {'Done':>7} {'To do':>7} {'Overdue':>8}",
+        ]
+        for name in names:
+            tasks, completed, overdue = self.users.get(name, (0, 0, 0))
+            lines.append(
+                f"{name:<20} {tasks:>7} {percent(tasks, self.total):>6.1f}% "
+                f"{percent(completed, tasks):>6.1f}% {percent(tasks - completed, tasks):>6.1f}% "
+                f"{percent(overdue, tasks):>7.1f}%"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_reports(self, users=(), task_path='task_overview.txt',
+                      user_path='user_overview.txt'):
+        """Write both reports"""
+        with open(task_path, 'w', encoding='utf-8') as f:
+            f.write(self.task_overview())
+        with open(user_path, 'w', encoding='utf-8') as f:
+            f.write(self.user_overview(users))
@@ -0,0 +1,720 @@
+# Indexed storage for task_manager.py
+#
+# tasks.txt stays the single source of truth: one record per line (see
+# task_codec.py), appended at the end. Next to it, tasks.txt.idx remembers the
+# byte offset of every task by user and by completion status, so one user's
+# tasks are read with a few seeks instead of a pass over the whole file.
+#
+# Tasks are also indexed by deadline. Each entry is one int, the due date's
+# ordinal shifted left past the task's offset, so a sorted collection of ints
+# orders tasks by deadline and bisect finds any date range in O(log n).
+#
+# Lines in tasks.txt are never changed in place. Completing, reassigning or
+# re-dating a task appends a small record to tasks.txt.log instead, and the
+# store applies those on top of the file when it reads. A task's id is the
+# byte offset of its line. Once enough of the file is out of date, compact()
+# rewrites it with every edit folded in and starts a new log.
+#
+# Several task_manager.py sessions may share one tasks.txt. Writers take an
+# flock on tasks.txt.lock, and every store catches up with lines and update
+# records the others appended (refresh()) before it trusts its offsets. When
+# another session compacts, every task id changes; generation counts those
+# rewrites so an edit picked from an older listing is refused.
+import bisect
+import contextlib
+import datetime
+import itertools
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock; sessions there are not locked against each other
+    fcntl = None
+
+from task_codec import (Task, decode, encode, format_legacy, migrate_legacy, parse_date,
+                        parse_legacy, read_records)
+from task_stats import TaskStats
+
+# Bump when the layout of tasks.txt.idx changes, so old indexes are rebuilt
+INDEX_VERSION = 4
+OFFSET_BITS = 40
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+# Fields an update record may change
+EDITABLE = ('user', 'due', 'completed')
+
+
+# Deadline index keys
+def due_key(day, offset=0):
+    """Sort key for a task at offset due on day (a date or datetime)"""
+    return day.toordinal() << OFFSET_BITS | offset
+
+
+def key_offset(key):
+    return key & OFFSET_MASK
+
+
+def as_date(value):
+    """Accept a date, a datetime or a 'dd Mon yyyy' string"""
+    if isinstance(value, str):
+        parsed = parse_date(value)
+        if parsed is None:
+            raise ValueError(f"Not a date in the form 10 Sep 2003: {value!r}")
+        return parsed.date()
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def overdue_cutoff(now=None):
+    """Last due date that counts as overdue at now (default: the current time)"""
+    # As in deadline_status, a deadline is the start of the due day
+    now = now or datetime.datetime.now()
+    last_day = as_date(now)
+    if now == datetime.datetime.combine(last_day, datetime.time()):
+        last_day -= datetime.timedelta(days=1)
+    return last_day
+
+
+def _remove_key(keys, key):
+    """Remove key from the sorted list keys, if it is there"""
+    position = bisect.bisect_left(keys, key)
+    if position < len(keys) and keys[position] == key:
+        del keys[position]
+
+
+class SortedKeys:
+    """Sorted ints kept in chunks of about CHUNK keys.
+
+    Adding or removing a key in one flat list of millions moves megabytes of
+    memory; here it moves at most one chunk, so edits cost the same however
+    big the task file gets.
+    """
+
+    CHUNK = 1000
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._chunks = [keys[i:i + self.CHUNK] for i in range(0, len(keys), self.CHUNK)]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._chunks)
+
+    def add(self, key):
+        chunks, maxes = self._chunks, self._maxes
+        self._len += 1
+        if not chunks:
+            chunks.append([key])
+            maxes.append(key)
+            return
+        i = bisect.bisect_left(maxes, key)
+        if i == len(maxes):
+            # Past the end, the usual case for a new task
+            i -= 1
+            chunks[i].append(key)
+            maxes[i] = key
+        else:
+            bisect.insort(chunks[i], key)
+        chunk = chunks[i]
+        if len(chunk) > 2 * self.CHUNK:
+            chunks[i:i + 1] = [chunk[:self.CHUNK], chunk[self.CHUNK:]]
+            maxes[i:i + 1] = [chunk[self.CHUNK - 1], chunk[-1]]
+
+    def extend(self, keys):
+        """Add many keys"""
+        if len(keys) < 64:
+            for key in keys:
+                self.add(key)
+        else:
+            # Rebuilding is cheaper than a key at a time; both inputs are
+            # mostly sorted runs, which sorted() takes advantage of
+            self.__init__(itertools.chain(self, keys))
+
+    def discard(self, key):
+        """Remove key if it is there"""
+        chunks, maxes = self._chunks, self._maxes
+        i = bisect.bisect_left(maxes, key)
+        if i == len(maxes):
+            return
+        chunk = chunks[i]
+        j = bisect.bisect_left(chunk, key)
+        if chunk[j] != key:
+            return
+        del chunk[j]
+        self._len -= 1
+        if not chunk:
+            del chunks[i]
+            del maxes[i]
+        elif j == len(chunk):
+            maxes[i] = chunk[-1]
+
+    def irange(self, low, high):
+        """Yield the keys from low up to, but not including, high"""
+        chunks = self._chunks
+        i = bisect.bisect_left(self._maxes, low)
+        start = bisect.bisect_left(chunks[i], low) if i < len(chunks) else 0
+        while i < len(chunks):
+            chunk = chunks[i]
+            end = bisect.bisect_left(chunk, high)
+            yield from chunk[start:end]
+            if end < len(chunk):
+                return
+            i += 1
+            start = 0
+
+
+class TaskStore:
+    """Append-only task file with an update log and per-user, per-status and
+    deadline indexes"""
+
+    def __init__(self, path='tasks.txt', compact_ratio=0.3):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.log_path = path + '.log'
+        # Compact once update records are this share of all records
+        self.compact_ratio = compact_ratio
+        self.by_user = {}
+        self.by_status = {}
+        # Deadline keys of every task, and of the tasks not yet completed
+        self.by_due = SortedKeys()
+        self.open_by_due = SortedKeys()
+        self.stats = None
+        self.size = 0
+        # Task id -> fields changed by the update log
+        self.updates = {}
+        self.log_records = 0
+        # How many log records the indexes already include, and how many
+        # bytes of the log have been read
+        self.log_applied = 0
+        self.log_size = 0
+        self.generation = 0
+        self.migrated = 0
+        self._inode = None
+        self._saved = None
+        self._ends_with_newline = True
+        self._lock_depth = 0
+
+    # Load the saved index and catch up with anything appended since
+    def open(self):
+        with self._locked():
+            if not os.path.exists(self.path):
+                with open(self.path, 'w') as f:
+                    f.write("")
+            # Files from before the record format are converted once, in place
+            self.migrated = migrate_legacy(self.path)
+        self._inode = self._identity()[0]
+        records, self.log_size = self._read_log()
+        if not self._load_index() or self.log_applied > len(records):
+            self._reset()
+        self._scan(self.size)
+        self._merge_log(records)
+        return self
+
+    # Merge the update log. Records the saved index already includes only
+    # need remembering; the rest are applied to the indexes too.
+    def _merge_log(self, records):
+        self.updates = {}
+        for number, (task_id, changes) in enumerate(records):
+            if number < self.log_applied:
+                self.updates.setdefault(task_id, {}).update(changes)
+            else:
+                self._apply(task_id, changes)
+        self.log_records = self.log_applied = len(records)
+
+    def refresh(self):
+        """Catch up with tasks other sessions added since the last look.
+
+        Returns True if the file was rewritten meanwhile, which changes
+        every task id.
+        """
+        inode, size = self._identity()
+        if inode != self._inode or size < self.size:
+            self._inode = inode
+            self._reset()
+            self._scan(0)
+            records, self.log_size = self._read_log()
+            self._merge_log(records)
+            self.generation += 1
+            return True
+        if size > self.size:
+            self._scan(self.size)
+        self._read_log_tail()
+        return False
+
+    # Apply update records other sessions (or update()) appended to the log
+    def _read_log_tail(self):
+        try:
+            if os.path.getsize(self.log_path) == self.log_size:
+                return
+        except FileNotFoundError:
+            return
+        records, self.log_size = self._read_log(self.log_size)
+        for task_id, changes in records:
+            self._apply(task_id, changes)
+        self.log_records += len(records)
+        self.log_applied += len(records)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the writers' lock shared by every session on this file"""
+        if fcntl is None or self._lock_depth:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def close(self):
+        """Compact if it is due, and save the index so the next start does not
+        rescan the file"""
+        self.compact_if_needed()
+        if self._saved != (self.size, self.stats.day, self.log_applied):
+            self._save_index()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _identity(self):
+        # A rewritten file (new inode) or a shorter one invalidates the index
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_size
+
+    def _reset(self):
+        self.by_user, self.by_status, self.size = {}, {}, 0
+        self.by_due, self.open_by_due = SortedKeys(), SortedKeys()
+        self.stats = TaskStats(overdue_cutoff().toordinal())
+        self.log_applied = 0
+        self._ends_with_newline = True
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        inode, size = self._identity()
+        if (saved.get('version') != INDEX_VERSION or saved.get('inode') != inode
+                or saved.get('size', 0) > size):
+            return False
+        self.by_user = saved['by_user']
+        self.by_status = {completed: SortedKeys(offsets)
+                          for completed, offsets in saved['by_status'].items()}
+        self.by_due = SortedKeys(saved['by_due'])
+        self.open_by_due = SortedKeys(saved['open_by_due'])
+        self.stats = TaskStats.from_dict(saved['stats'])
+        self.size = saved['size']
+        self.log_applied = saved['log_applied']
+        self._saved = (self.size, self.stats.day, self.log_applied)
+        return True
+
+    def _save_index(self):
+        # The inode the indexes were built against, which another session's
+        # compaction may since have replaced
+        state = {'version': INDEX_VERSION, 'inode': self._inode, 'size': self.size,
+                 'log_applied': self.log_applied,
+                 'by_user': self.by_user,
+                 'by_status': {completed: list(offsets)
+                               for completed, offsets in self.by_status.items()},
+                 'by_due': list(self.by_due), 'open_by_due': list(self.open_by_due),
+                 'stats': self.stats.to_dict()}
+        # Write to a temp file first so a crash never leaves half an index,
+        # one per process so two sessions closing at once do not mix theirs.
+        # json.dumps uses the C encoder; json.dump streams through the
+        # Python one and is several times slower on an index this size.
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(state, separators=(',', ':')))
+        os.replace(temp_path, self.index_path)
+        self._saved = (self.size, self.stats.day, self.log_applied)
+
+    # The update log: a header naming the tasks.txt it belongs to, then one
+    # [task id, {field: value}] record per line
+    def _read_log(self, start=0):
+        """Records from byte start on, and the position after the last one"""
+        try:
+            f = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return [], 0
+        records = []
+        with f:
+            if not start:
+                try:
+                    base = json.loads(f.readline())['base']
+                except (ValueError, KeyError, TypeError):
+                    base = None
+                if base != self._inode:
+                    # Left over from before a compaction, which already
+                    # folded it in; the next update starts a new log
+                    return [], 0
+                start = f.tell()
+            f.seek(start)
+            for line in f:
+                # A line without its newline is still being written, or was
+                # cut short by a crash; the next update truncates it
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    task_id, changes = json.loads(line)
+                except ValueError:
+                    break
+                records.append((task_id, changes))
+                start += len(line)
+        return records, start
+
+    def _append_log(self, task_id, changes):
+        with open(self.log_path, 'ab') as f:
+            if not self.log_size:
+                f.truncate(0)
+                f.write(json.dumps({'base': self._inode}).encode('utf-8') + b"\n")
+            else:
+                f.seek(0, os.SEEK_END)
+                if f.tell() != self.log_size:
+                    f.truncate(self.log_size)
+            f.write(json.dumps([task_id, changes], ensure_ascii=False).encode('utf-8') + b"\n")
+
+    # Index every line from byte start to the end of the file
+    def _scan(self, start):
+        batch = ([], [], {})
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if line.strip():
+                    try:
+                        task = decode(line.decode('utf-8'))
+                    except ValueError:
+                        if line.endswith(b"\n"):
+                            raise
+                        # Another session is still writing its last line
+                        # (or crashed doing so); leave it for the next look
+                        break
+                    self._add_to_index(task, offset, batch)
+                self._ends_with_newline = line.endswith(b"\n")
+                offset += len(line)
+        self.size = offset
+        self._merge_batch(batch)
+
+    # New entries are collected in a batch and merged into the sorted
+    # indexes once, which is much cheaper than adding them one at a time
+    def _add_to_index(self, task, offset, batch):
+        due, open_due, status = batch
+        self.stats.add(task)
+        self.by_user.setdefault(task.user, []).append(offset)
+        status.setdefault(task.completed, []).append(offset)
+        due_date = parse_date(task.due)
+        # Tasks without a valid deadline cannot be found by date
+        if due_date is not None:
+            key = due_key(due_date, offset)
+            due.append(key)
+            if task.completed != 'Yes':
+                open_due.append(key)
+
+    def _merge_batch(self, batch):
+        due, open_due, status = batch
+        self.by_due.extend(due)
+        self.open_by_due.extend(open_due)
+        for completed, offsets in status.items():
+            self.by_status.setdefault(completed, SortedKeys()).extend(offsets)
+
+    # Move a task from the index entries for old to those for new
+    def _reindex(self, task_id, old, new):
+        self.stats.remove(old)
+        self.stats.add(new)
+        if old.user != new.user:
+            _remove_key(self.by_user[old.user], task_id)
+            bisect.insort(self.by_user.setdefault(new.user, []), task_id)
+        if old.completed != new.completed:
+            self.by_status[old.completed].discard(task_id)
+            self.by_status.setdefault(new.completed, SortedKeys()).add(task_id)
+
+        old_date, new_date = parse_date(old.due), parse_date(new.due)
+        old_key = None if old_date is None else due_key(old_date, task_id)
+        new_key = None if new_date is None else due_key(new_date, task_id)
+        old_open = old_key if old.completed != 'Yes' else None
+        new_open = new_key if new.completed != 'Yes' else None
+        for keys, before, after in ((self.by_due, old_key, new_key),
+                                    (self.open_by_due, old_open, new_open)):
+            if before != after:
+                if before is not None:
+                    keys.discard(before)
+                if after is not None:
+                    keys.add(after)
+
+    def _apply(self, task_id, changes, old=None):
+        if old is None:
+            old = next(self._read_at([task_id]))
+        self.updates.setdefault(task_id, {}).update(changes)
+        self._reindex(task_id, old, old._replace(**changes))
+
+    # Writing
+    def add(self, task):
+        """Append a task and index it"""
+        self.add_many([task])
+
+    def add_many(self, tasks):
+        """Append several tasks with a single write to the file"""
+        with self._locked():
+            self.refresh()
+            data = b"".join(encode(task).encode('utf-8') for task in tasks)
+            with open(self.path, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() != self.size:
+                    # Half a line left by a session that crashed mid-write
+                    f.truncate(self.size)
+                # A file edited by hand may be missing its last newline
+                if not self._ends_with_newline:
+                    f.write(b"\n")
+                f.write(data)
+                end = f.tell()
+            if end - len(data) != self.size + (not self._ends_with_newline):
+                # Without flock another session may have written in between;
+                # index whatever is there now rather than trusting offsets
+                self._scan(self.size)
+                return
+            self._ends_with_newline = True
+            self.size = end - len(data)
+            batch = ([], [], {})
+            for task in tasks:
+                self._add_to_index(task, self.size, batch)
+                self.size += len(encode(task).encode('utf-8'))
+            self._merge_batch(batch)
+
+    # Edits, each one appended update record whatever the size of the file
+    def update(self, task_id, generation=None, **changes):
+        """Change the user, due or completed field of a task.
+
+        Pass the generation the task id was read at to have the edit
+        refused if another session has since rewritten the file.
+        """
+        unknown = set(changes) - set(EDITABLE)
+        if unknown:
+            raise ValueError(f"Cannot change {', '.join(sorted(unknown))}; "
+                             f"only {', '.join(EDITABLE)}")
+        if 'due' in changes:
+            as_date(changes['due'])
+        with self._locked():
+            self.get(task_id, generation)
+            self._append_log(task_id, changes)
+            # Reading the record back applies it, after any other session's
+            self._read_log_tail()
+
+    def complete(self, task_id, generation=None):
+        self.update(task_id, generation, completed='Yes')
+
+    def reassign(self, task_id, user, generation=None):
+        self.update(task_id, generation, user=user)
+
+    def set_deadline(self, task_id, due, generation=None):
+        self.update(task_id, generation, due=due)
+
+    # Compaction
+    def dead_ratio(self):
+        """Share of all records, lines and updates, that an up to date file
+        would not need"""
+        total = self.count() + self.log_records
+        return self.log_records / total if total else 0.0
+
+    def compact(self):
+        """Rewrite tasks.txt with every update folded in and start a new log"""
+        with self._locked():
+            self.refresh()
+            self._compact()
+
+    def _compact(self):
+        updates = self.updates
+        temp_path = self.path + '.tmp'
+        # The new file is indexed as it is written, so it is never read back
+        self._reset()
+        batch = ([], [], {})
+        with open(self.path, 'rb') as old, open(temp_path, 'wb') as new:
+            offset = 0
+            for line in old:
+                if line.strip():
+                    # A torn last line (see _scan) is dropped here
+                    try:
+                        task = decode(line.decode('utf-8'))
+                    except ValueError:
+                        if line.endswith(b"\n"):
+                            raise
+                        break
+                    changes = updates.get(offset)
+                    if changes:
+                        task = task._replace(**changes)
+                        data = encode(task).encode('utf-8')
+                    else:
+                        # Unchanged lines are copied as they are
+                        data = line if line.endswith(b"\n") else line + b"\n"
+                    new.write(data)
+                    self._add_to_index(task, self.size, batch)
+                    self.size += len(data)
+                offset += len(line)
+            new.flush()
+            os.fsync(new.fileno())
+        self._merge_batch(batch)
+        os.replace(temp_path, self.path)
+        self._inode = self._identity()[0]
+        self.generation += 1
+        # The log names the file it was written against, so even if removing
+        # it fails here, it is ignored from now on
+        try:
+            os.remove(self.log_path)
+        except FileNotFoundError:
+            pass
+        self.updates = {}
+        self.log_records = self.log_size = 0
+        self._save_index()
+
+    def compact_if_needed(self):
+        """Compact when update records pass compact_ratio of all records"""
+        if self.dead_ratio() > self.compact_ratio:
+            self.compact()
+            return True
+        return False
+
+    # Reading
+    def _read_at(self, offsets):
+        updates = self.updates
+        with open(self.path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                task = decode(f.readline().decode('utf-8'))
+                changes = updates.get(offset)
+                if changes:
+                    task = task._replace(**changes)
+                yield task
+
+    def get(self, task_id, generation=None):
+        """Return the task with this id, read at generation if given"""
+        self.refresh()
+        if generation is not None and generation != self.generation:
+            raise ValueError("The task list was rewritten by another session; "
+                             "list the tasks again")
+        return next(self._read_at([task_id]))
+
+    def tasks_at(self, task_ids):
+        """Yield the tasks with these ids, in the order given"""
+        return self._read_at(task_ids)
+
+    def task_ids_for(self, user):
+        """Ids of the tasks assigned to user, oldest first"""
+        self.refresh()
+        return list(self.by_user.get(user, []))
+
+    def tasks(self):
+        """Yield every task in the order it was added"""
+        self.refresh()
+        if not self.updates:
+            return read_records(self.path)
+        return self._merged_records()
+
+    def _merged_records(self):
+        updates = self.updates
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    task = decode(line.decode('utf-8'))
+                    changes = updates.get(offset)
+                    if changes:
+                        task = task._replace(**changes)
+                    yield task
+                offset += len(line)
+
+    def tasks_for(self, user):
+        """Yield only the tasks assigned to user"""
+        self.refresh()
+        return self._read_at(self.by_user.get(user, []))
+
+    def tasks_with_status(self, completed):
+        """Yield the tasks whose completed field is 'Yes' or 'No'"""
+        self.refresh()
+        return self._read_at(self.by_status.get(completed, ()))
+
+    def count(self, user=None):
+        """Number of tasks, for one user or overall"""
+        self.refresh()
+        if user is not None:
+            return len(self.by_user.get(user, []))
+        return sum(len(offsets) for offsets in self.by_user.values())
+
+    # Deadline queries, O(log n + k) for k matching tasks
+    def _due_range(self, keys, start, end):
+        """Offsets of the keys due from start to end, both days included"""
+        low = due_key(as_date(start))
+        high = due_key(as_date(end) + datetime.timedelta(days=1))
+        return [key_offset(key) for key in keys.irange(low, high)]
+
+    def due_between(self, start, end, include_completed=True):
+        """Yield tasks due from start to end inclusive, earliest deadline first"""
+        self.refresh()
+        keys = self.by_due if include_completed else self.open_by_due
+        return self._read_at(self._due_range(keys, start, end))
+
+    def overdue(self, now=None):
+        """Yield tasks not completed whose deadline has passed, oldest first"""
+        self.refresh()
+        last_day = overdue_cutoff(now)
+        high = due_key(last_day + datetime.timedelta(days=1))
+        return self._read_at([key_offset(key) for key in self.open_by_due.irange(0, high)])
+
+    def due_within(self, days, now=None):
+        """Yield tasks not completed that are due in the next days days"""
+        today = as_date(now or datetime.datetime.now())
+        return self.due_between(today, today + datetime.timedelta(days=days),
+                                include_completed=False)
+
+    # Statistics, kept current by every add
+    def statistics(self, now=None):
+        """Return the TaskStats, with overdue counts as of now"""
+        self.refresh()
+        day = overdue_cutoff(now).toordinal()
+        stats = self.stats
+        if day > stats.day:
+            # Only the open tasks whose deadline passed since the counts
+            # were last brought up to date need reading
+            since = datetime.date.fromordinal(stats.day + 1)
+            stats.mark_overdue(self._read_at(self._due_range(
+                self.open_by_due, since, datetime.date.fromordinal(day))))
+            stats.day = day
+        elif day < stats.day:
+            # The clock went back; count again from scratch
+            stats = TaskStats(day)
+            for task in self.tasks():
+                stats.add(task)
+            self.stats = stats
+        return stats
+
+    # Import/export in the old comma separated tasks.txt format
+    def import_text(self, path):
+        """Append every task from an old format tasks.txt"""
+        with open(path, encoding='utf-8') as f:
+            tasks = [parse_legacy(line) for line in f if line.strip()]
+        self.add_many(tasks)
+        return len(tasks)
+
+    def export_text(self, path):
+        """Write every task to a file in the old format"""
+        written = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for task in self.tasks():
+                f.write(("\n" if written else "") + format_legacy(task))
+                written += 1
+        return written